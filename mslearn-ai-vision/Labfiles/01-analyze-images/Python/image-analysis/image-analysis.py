@@ -1,75 +1,207 @@
 from dotenv import load_dotenv
 import os
-from PIL import Image, ImageDraw
-import sys
+from PIL import Image, ImageDraw, ImageFont
+import argparse
+import asyncio
+import glob
+import hashlib
+import io
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from matplotlib import pyplot as plt
 from azure.core.exceptions import HttpResponseError
 import requests
 
 # Import namespaces
 from azure.ai.vision.imageanalysis import ImageAnalysisClient
-from azure.ai.vision.imageanalysis.models import VisualFeatures
+from azure.ai.vision.imageanalysis.models import VisualFeatures, ImageAnalysisResult
 from azure.core.credentials import AzureKeyCredential
 
+from rate_limiter import RateLimiter
+
+
+VISUAL_FEATURES = [
+    VisualFeatures.CAPTION,
+    VisualFeatures.DENSE_CAPTIONS,
+    VisualFeatures.TAGS,
+    VisualFeatures.OBJECTS,
+    VisualFeatures.PEOPLE]
+
+ANALYSIS_API_VERSION = '2023-10-01'
+
+SEGMENT_API_VERSION = '2023-02-01-preview'
+SEGMENT_MODES = ('backgroundRemoval', 'foregroundMatting')
+SEGMENT_CHUNK_SIZE = 64 * 1024
+SAMPLE_IMAGE_URL = 'https://fifpro.org/media/5chb3dva/lionel-messi_imago1019567000h.jpg?raw=true'
+
+# Optional client-side downscaling before upload (--max-side / --quality)
+PreprocessOptions = namedtuple('PreprocessOptions', ['max_side', 'quality'])
+
+# Every Vision call goes through this limiter; retries are left to it instead of azure-core
+limiter = RateLimiter(rate=10)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.webp')
 
 
 def main():
     global cv_client
+    global limiter
+
+    parser = argparse.ArgumentParser(description='Analyze images with Azure AI Vision')
+    parser.add_argument('image', nargs='?', default='images/juan-francisco-rivas-lavalle--ssKnUQiY3M-unsplash.jpg',
+                        help='Image file to analyze')
+    parser.add_argument('--batch', help='Directory, glob pattern or manifest (.txt) of images to analyze')
+    parser.add_argument('--workers', type=int, default=8, help='Worker threads for batch mode')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help='Maximum requests in flight in batch mode (defaults to 2 x workers)')
+    parser.add_argument('--output', default='results.jsonl', help='JSON Lines file for batch results')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Measure batch throughput against a local stub server')
+    parser.add_argument('--benchmark-throttle', action='store_true',
+                        help='Run a batch against a local stub that enforces --rate and answers 429 above it')
+    parser.add_argument('--cache-dir', default='.analysis-cache', help='Directory for cached analysis results')
+    parser.add_argument('--no-cache', action='store_true', help='Always call the service, ignoring cached results')
+    parser.add_argument('--cache-max-mb', type=float, default=512, help='Maximum size of the result cache')
+    parser.add_argument('--cache-ttl-hours', type=float, default=24 * 7, help='Hours before a cached result expires')
+    parser.add_argument('--segment', nargs='+', metavar='SOURCE',
+                        help='Images, URLs, directories, globs or manifests to run background removal on')
+    parser.add_argument('--segment-modes', default=','.join(SEGMENT_MODES),
+                        help='Comma separated segmentation modes to run for each image')
+    parser.add_argument('--segment-output', default='segmented', help='Folder for segmentation results')
+    parser.add_argument('--max-side', type=int, default=None,
+                        help='Downscale images so the longest side is at most this many pixels before upload')
+    parser.add_argument('--quality', type=int, default=85, help='JPEG quality used when re-encoding for upload')
+    parser.add_argument('--benchmark-preprocess', action='store_true',
+                        help='Compare upload size and latency with and without --max-side for the input images')
+    parser.add_argument('--rate', type=float, default=10,
+                        help='Starting requests per second; adapts to 429 responses from the service')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Run analysis and segmentation concurrently with the asyncio clients')
+    parser.add_argument('--renderer', choices=['pillow', 'matplotlib'], default='pillow',
+                        help='How objects.jpg and people.jpg are drawn')
+    parser.add_argument('--benchmark-render', action='store_true',
+                        help='Compare the Pillow and matplotlib renderers on the input image')
+    args = parser.parse_args()
 
     try:
+        if args.benchmark_render:
+            BenchmarkRender(args.image)
+            return
+
+        limiter = RateLimiter(rate=args.rate)
+
+        if args.benchmark:
+            BenchmarkBatch(args.batch or 'images')
+            return
+
+        if args.benchmark_throttle:
+            BenchmarkThrottle(args.batch or 'images', quota=args.rate)
+            return
+
         #/ Get Configuration Settings .env
         load_dotenv()
         ai_endpoint = os.getenv('AI_SERVICE_ENDPOINT')
         ai_key = os.getenv('AI_SERVICE_KEY')
 
-        #/ Get image
-        image_file = 'images/juan-francisco-rivas-lavalle--ssKnUQiY3M-unsplash.jpg'
-        if len(sys.argv) > 1:
-            image_file = sys.argv[1]
-
-        with open(image_file, "rb") as f:
-            image_data = f.read()
-
         #/ Authenticate Azure AI Vision client
         cv_client = ImageAnalysisClient(
             endpoint=ai_endpoint,
-            credential=AzureKeyCredential(ai_key)
+            credential=AzureKeyCredential(ai_key),
+            api_version=ANALYSIS_API_VERSION,
+            retry_total=0
         )
+
+        preprocess = None
+        if args.max_side:
+            preprocess = PreprocessOptions(args.max_side, args.quality)
+
+        if args.benchmark_preprocess:
+            BenchmarkPreprocess(ListImages(args.batch or args.image), cv_client,
+                                preprocess or PreprocessOptions(2048, args.quality))
+            return
+
+        #/ Batch segmentation: every mode for every source over one pooled session
+        if args.segment:
+            sources = (source for pattern in args.segment for source in ListImages(pattern))
+            modes = [mode.strip() for mode in args.segment_modes.split(',') if mode.strip()]
+            SegmentBatch(ai_endpoint, ai_key, sources, args.segment_output, modes,
+                         workers=args.workers, max_in_flight=args.max_in_flight)
+            return
+
+        #/ Results already analyzed with the same bytes and features are read from disk
+        cache = None
+        if not args.no_cache:
+            cache = AnalysisCache(args.cache_dir,
+                                  max_bytes=int(args.cache_max_mb * 1024 * 1024),
+                                  ttl=args.cache_ttl_hours * 3600)
+
+        #/ Async mode: analysis and segmentation of each image run at the same time
+        if args.use_async:
+            modes = [mode.strip() for mode in args.segment_modes.split(',') if mode.strip()]
+            if args.batch:
+                asyncio.run(AnalyzeBatchAsync(ListImages(args.batch), ai_endpoint, ai_key, args.output,
+                                              args.segment_output, modes, concurrency=args.workers,
+                                              cache=cache, preprocess=preprocess))
+            else:
+                asyncio.run(AnalyzeImageAsync(args.image, ai_endpoint, ai_key, cache, args.renderer, preprocess))
+            return
+
+        #/ Batch mode: one shared client, results streamed as JSON Lines
+        if args.batch:
+            AnalyzeBatch(ListImages(args.batch), cv_client, args.output,
+                         workers=args.workers, max_in_flight=args.max_in_flight, cache=cache,
+                         preprocess=preprocess)
+            if cache is not None:
+                print('  Cache: {}'.format(cache.stats()))
+            return
+
+        #/ Get image
+        image_file = args.image
+        with open(image_file, "rb") as f:
+            image_data = f.read()
         
         #/ Analyze image
-        AnalyzeImage(image_file, image_data, cv_client)
+        AnalyzeImage(image_file, image_data, cv_client, cache, args.renderer, preprocess)
         
         # Background removal
-        BackgroundForeground(ai_endpoint, ai_key, image_file)
+        session = requests.Session()
+        BackgroundForeground(ai_endpoint, ai_key, SAMPLE_IMAGE_URL, session)
 
-        # Background removal image local
-        BackgroundForegroundLocal(ai_endpoint, ai_key, image_data)
+        # Background removal image local (the matte comes back at the uploaded size)
+        if preprocess is not None:
+            image_data, _ = PreprocessImage(image_data, preprocess)
+        BackgroundForegroundLocal(ai_endpoint, ai_key, image_data, session)
 
     except Exception as ex:
         print(ex)
 
 
-def AnalyzeImage(image_filename, image_data, cv_client):
+def AnalyzeImage(image_filename, image_data, cv_client, cache=None, renderer='pillow', preprocess=None):
     print('\nAnalyzing image...')
 
     try:
         # Get result with specified features to be retrieved
-        result = cv_client.analyze(
-            image_data=image_data,
-            visual_features=[
-                VisualFeatures.CAPTION,
-                VisualFeatures.DENSE_CAPTIONS,
-                VisualFeatures.TAGS,
-                VisualFeatures.OBJECTS,
-                VisualFeatures.PEOPLE],
-        )
-        
+        stats = {}
+        result = GetAnalysis(image_data, cv_client, cache, preprocess, stats)
+        if preprocess is not None and not stats.get('cached'):
+            print(' Uploaded {:.0f} KB instead of {:.0f} KB ({:.0%} saved), preprocessing {:.0f} ms, request {:.0f} ms'.format(
+                stats['bytes_sent'] / 1024, stats['bytes_original'] / 1024,
+                1 - stats['bytes_sent'] / stats['bytes_original'], stats['preprocess_ms'], stats['request_ms']))
 
     except HttpResponseError as e:
         print(f"Status code: {e.status_code}")
         print(f"Reason: {e.reason}")
-        print(f"Message: {e.error.message}")
+        print(f"Message: {e.error.message if e.error else e.message}")
+        return
+
+    ShowAnalysis(image_filename, result, renderer)
 
+
+def ShowAnalysis(image_filename, result, renderer='pillow'):
     #! Display analysis results
     #/ Get image captions
     if result.caption is not None:
@@ -91,18 +223,75 @@ def AnalyzeImage(image_filename, image_data, cv_client):
     #/ Get objects in the image
     if result.objects is not None:
         print("\nObjects in image:")
+        for detected_object in result.objects.list:
+            # Print object name
+            print(" {} (confidence: {:.2f}%)".format(detected_object.tags[0].name, detected_object.tags[0].confidence * 100))
+
+    #/ Get people in the image
+    if result.people is not None:
+        print("\nPeople in image:")
+        print(" {} people detected".format(len(result.people.list)))
+
+    #/ Save annotated images
+    if renderer == 'matplotlib':
+        outputfiles = SaveAnnotationsMatplotlib(image_filename, result)
+    else:
+        outputfiles = SaveAnnotations(image_filename, result)
+    for outputfile in outputfiles:
+        print('  Results saved in', outputfile)
+
+
+#! Pillow renderer: decode the image once and draw every box and label straight onto it
+def SaveAnnotations(image_filename, result, color='cyan'):
+    outputfiles = []
+    if result.objects is None and result.people is None:
+        return outputfiles
+
+    image = Image.open(image_filename)
+    image.load()
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    if result.objects is not None:
+        annotated = image.copy() if result.people is not None else image
+        boxes = [(o.bounding_box, o.tags[0].name) for o in result.objects.list]
+        DrawBoxes(annotated, boxes, color)
+        annotated.save('objects.jpg', quality=90)
+        outputfiles.append('objects.jpg')
+
+    if result.people is not None:
+        boxes = [(p.bounding_box, None) for p in result.people.list]
+        DrawBoxes(image, boxes, color)
+        image.save('people.jpg', quality=90)
+        outputfiles.append('people.jpg')
+
+    return outputfiles
 
+
+def DrawBoxes(image, boxes, color):
+    draw = ImageDraw.Draw(image)
+    font = ImageFont.load_default()
+    for r, label in boxes:
+        draw.rectangle(((r.x, r.y), (r.x + r.width, r.y + r.height)), outline=color, width=3)
+        if label:
+            # Label with a filled background, like plt.annotate(backgroundcolor=...)
+            left, top, right, bottom = draw.textbbox((r.x, r.y), label, font=font)
+            draw.rectangle((left - 2, top - 2, right + 2, bottom + 2), fill=color)
+            draw.text((r.x, r.y), label, fill='black', font=font)
+
+
+#! Original matplotlib renderer, kept for comparison (--renderer matplotlib)
+def SaveAnnotationsMatplotlib(image_filename, result, color='cyan'):
+    outputfiles = []
+
+    if result.objects is not None:
         # Prepare image for drawing
         image = Image.open(image_filename)
         fig = plt.figure(figsize=(image.width/100, image.height/100))
         plt.axis('off')
         draw = ImageDraw.Draw(image)
-        color = 'cyan'
 
         for detected_object in result.objects.list:
-            # Print object name
-            print(" {} (confidence: {:.2f}%)".format(detected_object.tags[0].name, detected_object.tags[0].confidence * 100))
-            
             # Draw object bounding box
             r = detected_object.bounding_box
             bounding_box = ((r.x, r.y), (r.x + r.width, r.y + r.height)) 
@@ -112,21 +301,16 @@ def AnalyzeImage(image_filename, image_data, cv_client):
         # Save annotated image
         plt.imshow(image)
         plt.tight_layout(pad=0)
-        outputfile = 'objects.jpg'
-        fig.savefig(outputfile)
-        print('  Results saved in', outputfile)
-
+        fig.savefig('objects.jpg')
+        plt.close(fig)
+        outputfiles.append('objects.jpg')
 
-    #/ Get people in the image
     if result.people is not None:
-        print("\nPeople in image:")
-
         # Prepare image for drawing
         image = Image.open(image_filename)
         fig = plt.figure(figsize=(image.width/100, image.height/100))
         plt.axis('off')
         draw = ImageDraw.Draw(image)
-        color = 'cyan'
 
         for detected_people in result.people.list:
             # Draw object bounding box
@@ -134,78 +318,741 @@ def AnalyzeImage(image_filename, image_data, cv_client):
             bounding_box = ((r.x, r.y), (r.x + r.width, r.y + r.height))
             draw.rectangle(bounding_box, outline=color, width=3)
 
-            # Return the confidence of the person detected
-            #print(" {} (confidence: {:.2f}%)".format(detected_people.bounding_box, detected_people.confidence * 100))
-            
         # Save annotated image
         plt.imshow(image)
         plt.tight_layout(pad=0)
-        outputfile = 'people.jpg'
-        fig.savefig(outputfile)
-        print('  Results saved in', outputfile)
-    
+        fig.savefig('people.jpg')
+        plt.close(fig)
+        outputfiles.append('people.jpg')
 
-def BackgroundForeground(endpoint, key, image_file):
-    # Define the API version and mode
-    api_version = "2023-02-01-preview"
-    mode="backgroundRemoval" # Can be "foregroundMatting" or "backgroundRemoval"
-    
-    # Remove the background from the image or generate a foreground matte
-    print('\nRemoving background from image...')
-        
-    url = "{}computervision/imageanalysis:segment?api-version={}&mode={}".format(endpoint, api_version, mode)
+    return outputfiles
 
-    headers= {
-        "Ocp-Apim-Subscription-Key": key, 
-        "Content-Type": "application/json" 
-    }
 
-    #/ En la original pide parámetros aca solo al url 
-    image_url="https://fifpro.org/media/5chb3dva/lionel-messi_imago1019567000h.jpg?raw=true"
+def BenchmarkRender(image_filename, repeats=5, boxes=20):
+    # Synthetic result with a grid of objects and people sized to the image
+    with Image.open(image_filename) as image:
+        width, height = image.size
+    box_w, box_h = width // 8, height // 8
+    values = [{"boundingBox": {"x": (i % 6) * box_w, "y": (i // 6 % 6) * box_h, "w": box_w, "h": box_h},
+               "tags": [{"name": "object {}".format(i), "confidence": 0.9}], "confidence": 0.9}
+              for i in range(boxes)]
+    result = ImageAnalysisResult({"modelVersion": ANALYSIS_API_VERSION,
+                                  "metadata": {"width": width, "height": height},
+                                  "objectsResult": {"values": values},
+                                  "peopleResult": {"values": values}})
 
-    body = {
-        "url": image_url,
-    }
-        
-    response = requests.post(url, headers=headers, json=body)
+    print('Rendering {} boxes on {} ({}x{}), {} runs each'.format(boxes, image_filename, width, height, repeats))
+    for name, render in (('matplotlib', SaveAnnotationsMatplotlib), ('pillow', SaveAnnotations)):
+        render(image_filename, result)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            render(image_filename, result)
+        elapsed = (time.perf_counter() - start) / repeats
+        print(' {:<10} {:>8.1f} ms per image'.format(name, elapsed * 1000))
 
-    image=response.content
-    with open("backgroundForeground.png", "wb") as file:
-        file.write(image)
-    print('  Results saved in backgroundForeground.png \n')
 
+def GetAnalysis(image_data, cv_client, cache=None, preprocess=None, stats=None):
+    # Results are always in the original image's coordinates, whether they come
+    # from the cache or from a downscaled upload
+    stats = {} if stats is None else stats
+    stats['bytes_original'] = len(image_data)
 
-#! Elimina el fondo de una imagen local usando la API de Azure Cognitive Services Computer Vision.
-def BackgroundForegroundLocal(endpoint, key, image_data):
+    key = None
+    if cache is not None:
+        key = cache.key(image_data, VISUAL_FEATURES, ANALYSIS_API_VERSION, preprocess)
+        cached = cache.get(key)
+        stats['cached'] = cached is not None
+        if cached is not None:
+            return ImageAnalysisResult(cached)
 
-    #/ Define la versión de la API y el modo
-    api_version = "2023-02-01-preview"
-    mode = "backgroundRemoval"  # Puede ser "foregroundMatting" o "backgroundRemoval"
+    start = time.perf_counter()
+    upload_data, scale = image_data, (1.0, 1.0)
+    if preprocess is not None:
+        upload_data, scale = PreprocessImage(image_data, preprocess)
+    stats['bytes_sent'] = len(upload_data)
+    stats['preprocess_ms'] = round((time.perf_counter() - start) * 1000, 1)
 
-    #/ Eliminar el fondo de la imagen
-    print('\nEliminando el fondo de la imagen...')
+    start = time.perf_counter()
+    result = limiter.call(cv_client.analyze, image_data=upload_data, visual_features=VISUAL_FEATURES)
+    stats['request_ms'] = round((time.perf_counter() - start) * 1000, 1)
+
+    if scale != (1.0, 1.0):
+        result = ImageAnalysisResult(ScaleResult(result.as_dict(), scale))
+    if cache is not None:
+        cache.put(key, result.as_dict())
+    return result
+
+
+#! Client-side downscaling before upload
+def PreprocessImage(image_data, options):
+    # Returns the bytes to upload and the (x, y) scale from original to uploaded coordinates
+    image = Image.open(io.BytesIO(image_data))
+    width, height = image.size
+    factor = min(1.0, options.max_side / max(width, height))
+    if factor == 1.0 and image.format == 'JPEG':
+        return image_data, (1.0, 1.0)
+
+    target = (max(1, round(width * factor)), max(1, round(height * factor)))
+    if factor < 1.0:
+        # JPEG draft mode lets the decoder skip most of the work for large reductions
+        image.draft('RGB', target)
+        image = image.resize(target, Image.LANCZOS)
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
 
-    url = "{}computervision/imageanalysis:segment?api-version={}&mode={}".format(endpoint, api_version, mode)
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=options.quality, optimize=True)
+    upload_data = buffer.getvalue()
+    if factor == 1.0 and len(upload_data) >= len(image_data):
+        return image_data, (1.0, 1.0)
+    return upload_data, (target[0] / width, target[1] / height)
 
-    headers = {
-        "Ocp-Apim-Subscription-Key": key,
-        "Content-Type": "application/octet-stream"  # Cambiado para manejar datos de imagen binarios
-    }
 
+def ScaleResult(result, scale):
+    # Map bounding boxes and polygons of a result dict back to original image coordinates
+    sx, sy = scale
+    for section in ('objectsResult', 'peopleResult', 'denseCaptionsResult', 'smartCropsResult'):
+        for value in (result.get(section) or {}).get('values', []):
+            box = value.get('boundingBox')
+            if box:
+                box['x'], box['w'] = round(box['x'] / sx), round(box['w'] / sx)
+                box['y'], box['h'] = round(box['y'] / sy), round(box['h'] / sy)
+
+    for block in (result.get('readResult') or {}).get('blocks', []):
+        for line in block.get('lines', []):
+            for item in [line] + line.get('words', []):
+                for point in item.get('boundingPolygon', []):
+                    point['x'], point['y'] = round(point['x'] / sx), round(point['y'] / sy)
+
+    metadata = result.get('metadata')
+    if metadata:
+        metadata['width'] = round(metadata['width'] / sx)
+        metadata['height'] = round(metadata['height'] / sy)
+    return result
+
+
+#! Async variant: analyze and segment concurrently, many images under a semaphore
+async def GetAnalysisAsync(image_data, aio_client, cache=None, preprocess=None):
+    # Hashing, cache files and resizing run in worker threads so they do not block
+    # the other coroutines on the event loop
+    key = None
+    if cache is not None:
+        key = await asyncio.to_thread(cache.key, image_data, VISUAL_FEATURES, ANALYSIS_API_VERSION, preprocess)
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            return ImageAnalysisResult(cached)
+
+    upload_data, scale = image_data, (1.0, 1.0)
+    if preprocess is not None:
+        upload_data, scale = await asyncio.to_thread(PreprocessImage, image_data, preprocess)
+    result = await limiter.call_async(aio_client.analyze, image_data=upload_data, visual_features=VISUAL_FEATURES)
+
+    if scale != (1.0, 1.0):
+        result = ImageAnalysisResult(ScaleResult(result.as_dict(), scale))
+    if cache is not None:
+        await asyncio.to_thread(cache.put, key, result.as_dict())
+    return result
+
+
+async def SegmentAsync(http_session, endpoint, key, source, mode, outputfile):
+    # Same request as Segment(), using aiohttp and streaming the body to disk
+    url = "{}computervision/imageanalysis:segment?api-version={}&mode={}".format(endpoint, SEGMENT_API_VERSION, mode)
+    headers = {"Ocp-Apim-Subscription-Key": key}
+    if isinstance(source, (bytes, bytearray)):
+        headers["Content-Type"] = "application/octet-stream"
+        response = await limiter.call_async(http_session.post, url, headers=headers, data=source)
+    else:
+        response = await limiter.call_async(http_session.post, url, headers=headers, json={"url": source})
+
+    async with response:
+        if response.status != 200:
+            return response.status
+        tmp_file = outputfile + '.part'
+        with open(tmp_file, "wb") as file:
+            async for chunk in response.content.iter_chunked(SEGMENT_CHUNK_SIZE):
+                file.write(chunk)
+        os.replace(tmp_file, outputfile)
+    return response.status
+
+
+def CreateAsyncClients(endpoint, key, connections):
+    # aiohttp is only needed for the --async mode
+    import aiohttp
+    from azure.ai.vision.imageanalysis.aio import ImageAnalysisClient as AsyncImageAnalysisClient
+
+    aio_client = AsyncImageAnalysisClient(endpoint=endpoint, credential=AzureKeyCredential(key),
+                                          api_version=ANALYSIS_API_VERSION, retry_total=0)
+    http_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=connections))
+    return aio_client, http_session
+
+
+async def AnalyzeImageAsync(image_file, endpoint, key, cache=None, renderer='pillow', preprocess=None):
+    print('\nAnalyzing image and removing background...')
+    with open(image_file, "rb") as f:
+        image_data = f.read()
+    segment_data = image_data
+    if preprocess is not None:
+        segment_data, _ = PreprocessImage(image_data, preprocess)
+
+    aio_client, http_session = CreateAsyncClients(endpoint, key, 3)
+    async with aio_client, http_session:
+        # The three requests overlap, so the wait is roughly the slowest one rather than the sum
+        result, url_status, local_status = await asyncio.gather(
+            GetAnalysisAsync(image_data, aio_client, cache, preprocess),
+            SegmentAsync(http_session, endpoint, key, SAMPLE_IMAGE_URL, "backgroundRemoval", "backgroundForeground.png"),
+            SegmentAsync(http_session, endpoint, key, segment_data, "backgroundRemoval", "backgroundForegroundLocal.png"),
+            return_exceptions=True)
+
+    if isinstance(result, HttpResponseError):
+        print(f"Status code: {result.status_code}")
+        print(f"Reason: {result.reason}")
+        print(f"Message: {result.error.message if result.error else result.message}")
+    elif isinstance(result, Exception):
+        print(result)
+    else:
+        ShowAnalysis(image_file, result, renderer)
+
+    for outputfile, status in (("backgroundForeground.png", url_status), ("backgroundForegroundLocal.png", local_status)):
+        if status == 200:
+            print('  Results saved in', outputfile)
+        else:
+            print('  {}: {}'.format(outputfile, status if isinstance(status, Exception) else 'Error: {}'.format(status)))
+
+
+def ReadImageFile(image_file):
+    with open(image_file, "rb") as f:
+        return f.read()
+
+
+async def AnalyzeImageItemAsync(image_file, aio_client, http_session, endpoint, key, output_folder, modes,
+                                cache=None, preprocess=None):
+    start = time.perf_counter()
+    record = {"image": image_file}
     try:
+        # Reading and resizing run in worker threads, off the event loop
+        image_data = await asyncio.to_thread(ReadImageFile, image_file)
+        segment_data = image_data
+        if preprocess is not None and modes:
+            segment_data, _ = await asyncio.to_thread(PreprocessImage, image_data, preprocess)
+    except Exception as e:
+        # Unreadable or corrupt image: recorded like any other failure, the batch goes on
+        record["error"] = {"type": type(e).__name__, "message": str(e)}
+        record["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        return record
+
+    name = OutputName(image_file)
+    outputfiles = [os.path.join(output_folder, '{}.{}.png'.format(name, mode)) for mode in modes]
 
-        response = requests.post(url, headers=headers, data=image_data)
+    results = await asyncio.gather(
+        GetAnalysisAsync(image_data, aio_client, cache, preprocess),
+        *[SegmentAsync(http_session, endpoint, key, segment_data, mode, outputfile)
+          for mode, outputfile in zip(modes, outputfiles)],
+        return_exceptions=True)
 
-        if response.status_code == 200:
-            image=response.content
-            with open("backgroundForegroundLocal.png", "wb") as file:
-                file.write(image)
-            print('  Results saved in backgroundForegroundLocal.png \n')
+    result = results[0]
+    if isinstance(result, HttpResponseError):
+        record["error"] = {"status_code": result.status_code, "reason": result.reason, "message": str(result)}
+    elif isinstance(result, Exception):
+        record["error"] = {"message": str(result)}
+    else:
+        record["result"] = result.as_dict()
+    record["segments"] = [
+        {"mode": mode, "output": outputfile, "status_code": status} if not isinstance(status, Exception)
+        else {"mode": mode, "output": outputfile, "error": str(status)}
+        for mode, outputfile, status in zip(modes, outputfiles, results[1:])]
+    record["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return record
+
+
+async def AnalyzeBatchAsync(image_files, endpoint, key, output, output_folder, modes=SEGMENT_MODES,
+                            concurrency=8, cache=None, preprocess=None):
+    # A fixed number of worker coroutines pull from the shared iterator, so only
+    # `concurrency` images are in memory and in flight at any time
+    os.makedirs(output_folder, exist_ok=True)
+    image_files = iter(image_files)
+    counts = {"processed": 0, "failed": 0}
+    start = time.perf_counter()
+
+    aio_client, http_session = CreateAsyncClients(endpoint, key, concurrency * (1 + len(modes)))
+    async with aio_client, http_session:
+        with open(output, 'w', encoding='utf-8') as out:
+
+            async def Worker():
+                for image_file in image_files:
+                    record = await AnalyzeImageItemAsync(image_file, aio_client, http_session, endpoint, key,
+                                                         output_folder, modes, cache, preprocess)
+                    out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    counts["processed"] += 1
+                    counts["failed"] += 'error' in record
+
+            await asyncio.gather(*[Worker() for _ in range(concurrency)])
+
+    elapsed = time.perf_counter() - start
+    rate = counts["processed"] / elapsed if elapsed > 0 else 0.0
+    print('\n{} images analyzed ({} failed) in {:.2f}s ({:.1f} images/sec)'.format(
+        counts["processed"], counts["failed"], elapsed, rate))
+    print('  Results saved in', output)
+    return counts["processed"], elapsed
+
+
+def BenchmarkPreprocess(image_files, cv_client, preprocess):
+    # Upload each image as-is and downscaled, and report the size and latency difference
+    print('Comparing uploads with max side {} px and quality {}'.format(preprocess.max_side, preprocess.quality))
+    print('\n {:<40} {:>9} {:>9} {:>6} {:>9} {:>9} {:>9}'.format(
+        'Image', 'Orig KB', 'Sent KB', 'Saved', 'Raw ms', 'Prep ms', 'Change'))
+    for image_file in image_files:
+        with open(image_file, "rb") as f:
+            image_data = f.read()
+
+        raw, scaled = {}, {}
+        start = time.perf_counter()
+        GetAnalysis(image_data, cv_client, stats=raw)
+        raw_ms = (time.perf_counter() - start) * 1000
+        start = time.perf_counter()
+        GetAnalysis(image_data, cv_client, preprocess=preprocess, stats=scaled)
+        scaled_ms = (time.perf_counter() - start) * 1000
+
+        print(' {:<40} {:>9.0f} {:>9.0f} {:>6.0%} {:>9.0f} {:>9.0f} {:>+9.0f}'.format(
+            os.path.basename(image_file)[:40], raw['bytes_original'] / 1024, scaled['bytes_sent'] / 1024,
+            1 - scaled['bytes_sent'] / raw['bytes_original'], raw_ms, scaled_ms, scaled_ms - raw_ms))
+
+
+#! Content-addressed cache of analysis results on disk
+class AnalysisCache:
+    # Entries are JSON files named by sha256(image bytes + features + API version).
+    # The least recently used entries are evicted once max_bytes is exceeded and
+    # entries older than ttl seconds are treated as misses.
+
+    def __init__(self, folder, max_bytes=512 * 1024 * 1024, ttl=7 * 24 * 3600):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+
+        os.makedirs(folder, exist_ok=True)
+        # Rebuild the LRU order from the files' access times
+        existing = []
+        for name in os.listdir(folder):
+            if name.endswith('.json'):
+                stat = os.stat(os.path.join(folder, name))
+                existing.append((stat.st_mtime, name[:-5], stat.st_size))
+        for _, key, size in sorted(existing):
+            self._entries[key] = size
+            self._size += size
+
+    @staticmethod
+    def key(image_data, visual_features, api_version, preprocess=None):
+        digest = hashlib.sha256(image_data)
+        features = ','.join(sorted(str(feature) for feature in visual_features))
+        digest.update('|{}|{}'.format(features, api_version).encode('utf-8'))
+        if preprocess is not None:
+            digest.update('|{}'.format(tuple(preprocess)).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + '.json')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+
+        with self._lock:
+            if entry is None or key not in self._entries or time.time() - entry['created'] > self.ttl:
+                if key in self._entries:
+                    self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            os.utime(path)
+            self.hits += 1
+            return entry['result']
+
+    def put(self, key, result):
+        data = json.dumps({'created': time.time(), 'result': result}).encode('utf-8')
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            path = self._path(key)
+            tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self._entries[key] = len(data)
+            self._size += len(data)
+
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        self._size -= self._entries.pop(key)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / total, 3) if total else 0.0,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self._size,
+        }
+
+
+#! Batch mode: analyze many images with a bounded pool of requests in flight
+def ListImages(source):
+    # Yield image paths from a directory, a manifest file (one path or URL per line) or a glob pattern
+    if IsUrl(source):
+        yield source
+    elif os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.join(root, name)
+    elif os.path.isfile(source) and not source.lower().endswith(IMAGE_EXTENSIONS):
+        base = os.path.dirname(source)
+        with open(source, 'r') as manifest:
+            for line in manifest:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    yield line if os.path.isabs(line) or IsUrl(line) else os.path.join(base, line)
+    else:
+        yield from sorted(glob.glob(source, recursive=True))
+
+
+def IsUrl(source):
+    return source.startswith(('http://', 'https://'))
+
+
+def AnalyzeBatchItem(image_file, cv_client, cache=None, preprocess=None):
+    start = time.perf_counter()
+    record = {"image": image_file}
+    try:
+        if IsUrl(image_file):
+            # The service downloads the image itself, so there is nothing to cache or downscale
+            record["result"] = limiter.call(cv_client.analyze_from_url, image_url=image_file,
+                                            visual_features=VISUAL_FEATURES).as_dict()
+        else:
+            with open(image_file, "rb") as f:
+                image_data = f.read()
+            stats = {}
+            record["result"] = GetAnalysis(image_data, cv_client, cache, preprocess, stats).as_dict()
+            record["upload"] = stats
+    except HttpResponseError as e:
+        record["error"] = {"status_code": e.status_code, "reason": e.reason, "message": str(e)}
+    except Exception as e:
+        # Connection errors, unreadable images...: recorded per image, the batch goes on
+        record["error"] = {"type": type(e).__name__, "message": str(e)}
+    record["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 1)
+    return record
+
+
+def AnalyzeBatch(image_files, cv_client, output, workers=8, max_in_flight=None, cache=None, preprocess=None):
+    # The image list is consumed lazily: at most max_in_flight images are read and
+    # waiting on the service at any time, and each result is written as soon as it arrives
+    max_in_flight = max(1, max_in_flight or workers * 2)
+    image_files = iter(image_files)
+    pending = set()
+    processed = failed = 0
+    start = time.perf_counter()
+
+    with open(output, 'w', encoding='utf-8') as out, ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            for image_file in image_files:
+                pending.add(pool.submit(AnalyzeBatchItem, image_file, cv_client, cache, preprocess))
+                if len(pending) >= max_in_flight:
+                    break
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                record = future.result()
+                out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                processed += 1
+                failed += 'error' in record
+            out.flush()
+
+    elapsed = time.perf_counter() - start
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    print('\n{} images analyzed ({} failed) in {:.2f}s ({:.1f} images/sec)'.format(processed, failed, elapsed, rate))
+    print('  Results saved in', output)
+    return processed, elapsed
+
+
+#! Benchmark: batch throughput against a local stub of the analyze endpoint
+STUB_ANALYSIS = {
+    "modelVersion": "2023-10-01",
+    "metadata": {"width": 800, "height": 600},
+    "captionResult": {"text": "a stub caption", "confidence": 0.9},
+    "tagsResult": {"values": [{"name": "stub", "confidence": 0.9}]},
+    "objectsResult": {"values": [{"boundingBox": {"x": 10, "y": 10, "w": 100, "h": 100},
+                                  "tags": [{"name": "thing", "confidence": 0.8}]}]},
+    "peopleResult": {"values": [{"boundingBox": {"x": 20, "y": 20, "w": 50, "h": 150}, "confidence": 0.9}]},
+}
+
+
+def StartStubServer(latency=0.05, quota=None):
+    # With a quota (requests/sec) the stub behaves like a throttled tier and
+    # answers 429 with a Retry-After header once the quota is exceeded
+    body = json.dumps(STUB_ANALYSIS).encode('utf-8')
+    lock = threading.Lock()
+    window = {"start": time.monotonic(), "count": 0}
+
+    def OverQuota():
+        with lock:
+            now = time.monotonic()
+            if now - window["start"] >= 1.0:
+                window["start"], window["count"] = now, 0
+            window["count"] += 1
+            if window["count"] <= quota:
+                return False, 0.0
+            server.throttled += 1
+            return True, 1.0 - (now - window["start"])
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True  # Headers and body go out in separate writes
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if quota is not None:
+                throttled, retry_after = OverQuota()
+                if throttled:
+                    error = json.dumps({"error": {"code": "429", "message": "Rate limit is exceeded."}}).encode('utf-8')
+                    self.send_response(429)
+                    self.send_header('Retry-After', str(max(1, round(retry_after))))
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(error)))
+                    self.end_headers()
+                    self.wfile.write(error)
+                    return
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.throttled = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def BenchmarkBatch(source, concurrency_levels=(1, 2, 4, 8, 16), latency=0.05):
+    global limiter
+
+    image_files = list(ListImages(source))
+    if not image_files:
+        print('No images found in', source)
+        return
+
+    # Repeat the sample images so every run has enough work to keep the pool busy
+    image_files = (image_files * (64 // len(image_files) + 1))[:64]
+    server = StartStubServer(latency)
+    endpoint = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    client = ImageAnalysisClient(endpoint=endpoint, credential=AzureKeyCredential('stub'), retry_total=0)
+    limiter = RateLimiter(rate=1000)  # The stub has no quota: measure concurrency, not the limiter
+
+    print('Benchmarking {} images against stub server ({:.0f} ms latency)'.format(len(image_files), latency * 1000))
+    rows = []
+    try:
+        for workers in concurrency_levels:
+            processed, elapsed = AnalyzeBatch(image_files, client, os.devnull, workers=workers)
+            rows.append((workers, processed / elapsed))
+    finally:
+        server.shutdown()
+
+    print('\n Concurrency  Images/sec')
+    for workers, rate in rows:
+        print(' {:>11}  {:>10.1f}'.format(workers, rate))
+
+
+def BenchmarkThrottle(source, quota=10, images=100):
+    # Push a batch at a stub that only allows `quota` requests per second and check
+    # that the limiter settles at the quota without failed images
+    global limiter
+
+    image_files = list(ListImages(source))
+    if not image_files:
+        print('No images found in', source)
+        return
+    image_files = (image_files * (images // len(image_files) + 1))[:images]
+
+    server = StartStubServer(latency=0.02, quota=quota)
+    endpoint = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    client = ImageAnalysisClient(endpoint=endpoint, credential=AzureKeyCredential('stub'), retry_total=0)
+
+    # Start well above the quota so the limiter has to learn it from the 429s
+    limiter = RateLimiter(rate=quota * 3)
+    print('Sending {} images to a stub limited to {} requests/sec'.format(len(image_files), quota))
+    try:
+        processed, elapsed = AnalyzeBatch(image_files, client, os.devnull, workers=16)
+    finally:
+        server.shutdown()
+
+    print('  Throughput: {:.1f} images/sec (quota {})'.format(processed / elapsed, quota))
+    print('  429 responses from stub: {}'.format(server.throttled))
+    print('  Limiter: {}'.format(limiter.stats()))
+
+
+def BackgroundForeground(endpoint, key, image_url=SAMPLE_IMAGE_URL, session=None):
+    # Remove the background from the image or generate a foreground matte
+    print('\nRemoving background from image...')
+
+    outputfile = "backgroundForeground.png"
+    status = Segment(session or requests.Session(), endpoint, key, image_url, "backgroundRemoval", outputfile)
+    if status == 200:
+        print('  Results saved in {} \n'.format(outputfile))
+    else:
+        print(f"Error: {status}")
+
+
+#! Elimina el fondo de una imagen local usando la API de Azure Cognitive Services Computer Vision.
+def BackgroundForegroundLocal(endpoint, key, image_data, session=None):
+
+    #/ Eliminar el fondo de la imagen
+    print('\nEliminando el fondo de la imagen...')
+
+    outputfile = "backgroundForegroundLocal.png"
+    try:
+        status = Segment(session or requests.Session(), endpoint, key, image_data, "backgroundRemoval", outputfile)
+        if status == 200:
+            print('  Results saved in {} \n'.format(outputfile))
         else:
-            print(f"Error: {response.status_code}")
+            print(f"Error: {status}")
 
     except FileNotFoundError:
         print("Error: No se encontró el archivo de imagen.")
 
+
+def Segment(session, endpoint, key, source, mode, outputfile):
+    # source can be image bytes, a local file path or a URL.
+    # mode can be "foregroundMatting" or "backgroundRemoval".
+    url = "{}computervision/imageanalysis:segment?api-version={}&mode={}".format(endpoint, SEGMENT_API_VERSION, mode)
+    headers = {"Ocp-Apim-Subscription-Key": key}
+
+    if isinstance(source, (bytes, bytearray)):
+        headers["Content-Type"] = "application/octet-stream"
+        response = limiter.call(session.post, url, headers=headers, data=source, stream=True)
+    elif IsUrl(source):
+        headers["Content-Type"] = "application/json"
+        response = limiter.call(session.post, url, headers=headers, json={"url": source}, stream=True)
+    else:
+        # Passing the open file lets requests stream the upload instead of reading it all first;
+        # the file is reopened for every attempt so a retry sends the whole image again
+        headers["Content-Type"] = "application/octet-stream"
+
+        def PostFile():
+            with open(source, "rb") as image_file:
+                return session.post(url, headers=headers, data=image_file, stream=True)
+
+        response = limiter.call(PostFile)
+
+    # The response body is written in chunks so memory stays flat whatever the image size
+    with response:
+        if response.status_code != 200:
+            return response.status_code
+        tmp_file = outputfile + '.part'
+        with open(tmp_file, "wb") as file:
+            for chunk in response.iter_content(chunk_size=SEGMENT_CHUNK_SIZE):
+                file.write(chunk)
+        os.replace(tmp_file, outputfile)
+    return response.status_code
+
+
+#! Batch mode for background removal / foreground matting
+def CreateSession(pool_size):
+    # One keep-alive connection pool shared by every worker thread
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def OutputName(source):
+    # Base name for the files written for one image: its name plus a short hash of its
+    # URL or absolute path, so images with the same name in different folders (or
+    # sites) never write to the same output or temporary file
+    if IsUrl(source):
+        name, key = os.path.basename(source.split('?')[0]), source
+    else:
+        name, key = os.path.basename(source), os.path.abspath(source)
+    name = os.path.splitext(name)[0] or 'image'
+    return '{}-{}'.format(name, hashlib.sha1(key.encode('utf-8')).hexdigest()[:8])
+
+
+def SegmentBatchItem(session, endpoint, key, source, modes, output_folder):
+    name = OutputName(source)
+
+    records = []
+    for mode in modes:
+        start = time.perf_counter()
+        outputfile = os.path.join(output_folder, '{}.{}.png'.format(name, mode))
+        record = {"image": source, "mode": mode, "output": outputfile}
+        try:
+            record["status_code"] = Segment(session, endpoint, key, source, mode, outputfile)
+            if record["status_code"] != 200:
+                record["error"] = "HTTP {}".format(record["status_code"])
+        except (OSError, requests.RequestException) as e:
+            record["error"] = str(e)
+        record["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        records.append(record)
+    return records
+
+
+def SegmentBatch(endpoint, key, sources, output_folder, modes=SEGMENT_MODES, workers=8, max_in_flight=None):
+    os.makedirs(output_folder, exist_ok=True)
+    max_in_flight = max(1, max_in_flight or workers * 2)
+    sources = iter(sources)
+    pending = set()
+    processed = failed = 0
+    start = time.perf_counter()
+
+    with CreateSession(workers) as session, ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            for source in sources:
+                pending.add(pool.submit(SegmentBatchItem, session, endpoint, key, source, modes, output_folder))
+                if len(pending) >= max_in_flight:
+                    break
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for record in future.result():
+                    processed += 1
+                    if 'error' in record:
+                        failed += 1
+                        print('  {} ({}): {}'.format(record['image'], record['mode'], record['error']))
+
+    elapsed = time.perf_counter() - start
+    rate = processed / elapsed if elapsed > 0 else 0.0
+    print('\n{} segmentations ({} failed) in {:.2f}s ({:.1f}/sec)'.format(processed, failed, elapsed, rate))
+    print('  Results saved in', output_folder)
+    return processed, elapsed
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,275 @@
+# Shared rate limiter and retry scheduler for Azure AI Vision calls.
+#
+# One RateLimiter is shared by every thread (or coroutine) calling the same
+# resource. Requests are spaced with a token bucket; the rate grows slowly while
+# calls succeed and drops when the service answers 429. The rate that drew the
+# 429 is remembered as a ceiling: the limiter climbs back to just under it
+# quickly and only probes above it slowly, so it settles near the quota instead
+# of sawing between half of it and just over it. On Retry-After the limiter
+# pauses, and callers already waiting for a slot re-queue behind the pause
+# instead of firing into it. Connection errors (refused, reset, timed out) are
+# retried too, since the SDK clients' own retries are turned off. Retries use
+# jittered exponential backoff and draw from a retry budget, so a failing
+# service cannot multiply the load it receives.
+#
+# Each lab folder is run on its own from its own directory (there is no package
+# to install), so every folder that calls the service keeps an identical copy of
+# this file. Change them together.
+import asyncio
+import collections
+import random
+import threading
+import time
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class RateLimiter:
+
+    def __init__(self, rate=10.0, burst=1, min_rate=0.5, max_rate=None, increase=0.1, backoff=0.95, probe=0.02,
+                 max_retries=6, base_delay=0.5, max_delay=30.0, retry_ratio=0.2, min_retry_budget=50):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate * 4
+        self.increase = increase
+        self.backoff = backoff
+        self.probe = probe
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_ratio = retry_ratio
+        self.min_retry_budget = min_retry_budget
+
+        self.calls = 0
+        self.throttled = 0
+        self.retries = 0
+        self.failures = 0
+
+        self._lock = threading.Lock()
+        self._next_time = time.monotonic()
+        self._last_decrease = 0.0
+        self._ceiling = None
+        self._accepted = collections.deque()
+        self._pause_until = 0.0
+        self._pauses = 0
+        self._retry_budget = float(min_retry_budget)
+
+    #! Token bucket
+    def _reserve(self):
+        # Returns how long the caller must wait for its slot, and the pause count
+        # the slot was reserved under
+        with self._lock:
+            now = time.monotonic()
+            interval = 1.0 / self.rate
+            slot = max(self._next_time, self._pause_until, now - (self.burst - 1) * interval)
+            self._next_time = slot + interval
+            return max(0.0, slot - now), self._pauses
+
+    def _paused_since(self, pauses):
+        with self._lock:
+            return self._pauses != pauses
+
+    def acquire(self):
+        while True:
+            wait, pauses = self._reserve()
+            if wait > 0:
+                time.sleep(wait)
+            # A slot reserved before a pause started would land inside it
+            if not self._paused_since(pauses):
+                return
+
+    async def acquire_async(self):
+        while True:
+            wait, pauses = self._reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if not self._paused_since(pauses):
+                return
+
+    #! Feedback from the service
+    def _on_success(self):
+        with self._lock:
+            self.calls += 1
+            now = time.monotonic()
+            self._accepted.append(now)
+            while self._accepted[0] < now - 1.0:
+                self._accepted.popleft()
+            # Below the last rate that drew a 429 the rate climbs quickly; above it,
+            # it only probes in case the quota has grown
+            if self._ceiling is not None and self.rate >= self._ceiling * self.backoff:
+                self.rate = min(self.max_rate, self.rate + self.increase * self.probe)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.increase)
+            self._retry_budget = min(self.min_retry_budget * 10, self._retry_budget + self.retry_ratio)
+
+    def _on_retryable(self, status, retry_after, attempt):
+        # Returns the delay before the next attempt, or None when no retry is allowed
+        with self._lock:
+            self.calls += 1
+            now = time.monotonic()
+            if status == 429:
+                self.throttled += 1
+                # Requests already in flight when the quota was hit come back as 429 too;
+                # only the first of them should lower the rate
+                if now - self._last_decrease > 1.0:
+                    accepted = len(self._accepted)
+                    if accepted >= self.rate / 2:
+                        # What the service let through in the last second is about the
+                        # quota: settle just under it
+                        self._ceiling = min(self.rate, float(accepted))
+                        self.rate = max(self.min_rate, self._ceiling * self.backoff)
+                    else:
+                        # Too little got through to tell where the quota is
+                        self._ceiling = self.rate
+                        self.rate = max(self.min_rate, self.rate / 2)
+                    self._last_decrease = now
+            if attempt >= self.max_retries or self._retry_budget < 1:
+                self.failures += 1
+                return None
+            self._retry_budget -= 1
+            self.retries += 1
+
+            if retry_after is not None:
+                # Nobody should call before the service is ready again. The limiter
+                # holds this caller too, so it only needs to re-queue; slots already
+                # handed out are re-queued behind the pause by acquire()
+                if now + retry_after > self._pause_until:
+                    self._pause_until = now + retry_after
+                    self._next_time = self._pause_until
+                    self._pauses += 1
+                delay = 0.0
+            else:
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+            return delay
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'throttled': self.throttled,
+            'retries': self.retries,
+            'failures': self.failures,
+            'rate': round(self.rate, 2),
+        }
+
+    #! Calling through the limiter
+    def call(self, fn, *args, **kwargs):
+        # fn is called again on retry, so it must not consume a stream passed in from outside
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                response = fn(*args, **kwargs)
+            except Exception as error:
+                status, retry_after = ThrottleInfo(error)
+                if status not in RETRY_STATUS_CODES:
+                    if not IsConnectionError(error):
+                        raise
+                    status = None
+                delay = self._on_retryable(status, retry_after, attempt)
+                if delay is None:
+                    raise
+            else:
+                status, retry_after = ThrottleInfo(response)
+                if status not in RETRY_STATUS_CODES:
+                    self._on_success()
+                    return response
+                delay = self._on_retryable(status, retry_after, attempt)
+                if delay is None:
+                    return response
+                CloseResponse(response)
+            attempt += 1
+            time.sleep(delay)
+
+    async def call_async(self, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            await self.acquire_async()
+            try:
+                response = await fn(*args, **kwargs)
+            except Exception as error:
+                status, retry_after = ThrottleInfo(error)
+                if status not in RETRY_STATUS_CODES:
+                    if not IsConnectionError(error):
+                        raise
+                    status = None
+                delay = self._on_retryable(status, retry_after, attempt)
+                if delay is None:
+                    raise
+            else:
+                status, retry_after = ThrottleInfo(response)
+                if status not in RETRY_STATUS_CODES:
+                    self._on_success()
+                    return response
+                delay = self._on_retryable(status, retry_after, attempt)
+                if delay is None:
+                    return response
+                CloseResponse(response)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+_connection_errors = None
+
+
+def ConnectionErrors():
+    # Exception types for transient network failures, from whichever HTTP
+    # libraries are installed (looked up once, on the first error)
+    global _connection_errors
+    if _connection_errors is None:
+        errors = [ConnectionError, TimeoutError]
+        try:
+            from azure.core.exceptions import ServiceRequestError, ServiceResponseError
+            errors += [ServiceRequestError, ServiceResponseError]
+        except ImportError:
+            pass
+        try:
+            import requests
+            errors += [requests.ConnectionError, requests.Timeout]
+        except ImportError:
+            pass
+        try:
+            import aiohttp
+            errors += [aiohttp.ClientConnectionError]
+        except ImportError:
+            pass
+        _connection_errors = tuple(errors)
+    return _connection_errors
+
+
+def IsConnectionError(error):
+    # msrest clients wrap the requests error in ClientRequestError
+    inner = getattr(error, 'inner_exception', None)
+    return isinstance(error, ConnectionErrors()) or isinstance(inner, ConnectionErrors())
+
+
+def ThrottleInfo(obj):
+    # Status code and Retry-After (seconds) from an azure-core / msrest exception
+    # or from a requests / aiohttp response
+    status = getattr(obj, 'status_code', None)
+    if status is None:
+        status = getattr(obj, 'status', None)
+    response = getattr(obj, 'response', None)
+    if status is None and response is not None:
+        status = getattr(response, 'status_code', None) or getattr(response, 'status', None)
+
+    headers = getattr(obj, 'headers', None)
+    if headers is None and response is not None:
+        headers = getattr(response, 'headers', None)
+    if not isinstance(status, int) or headers is None:
+        return status, None
+
+    for name, factor in (('retry-after-ms', 0.001), ('x-ms-retry-after-ms', 0.001), ('Retry-After', 1.0)):
+        value = headers.get(name)
+        if value:
+            try:
+                return status, max(0.0, float(value) * factor)
+            except ValueError:
+                pass
+    return status, None
+
+
+def CloseResponse(response):
+    close = getattr(response, 'close', None)
+    if callable(close):
+        close()
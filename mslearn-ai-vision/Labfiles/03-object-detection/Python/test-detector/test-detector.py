@@ -1,13 +1,62 @@
 from azure.cognitiveservices.vision.customvision.prediction import CustomVisionPredictionClient
+from azure.cognitiveservices.vision.customvision.prediction.models import ImagePrediction
 from msrest.authentication import ApiKeyCredentials
-from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
+import argparse
+import csv
+import functools
+import io
 import os
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Shared limiter with retries on 429 for the tile requests
+from rate_limiter import RateLimiter
+
+limiter = RateLimiter(rate=10)
+
+# Detections after post-processing, as compact arrays: boxes (n, 4) in pixels as
+# (left, top, right, bottom), scores (n,), tags (n,) indexing tag_names
+Detections = namedtuple('Detections', ['boxes', 'scores', 'tags', 'tag_names'])
+
+# Longest side images are decoded at for drawing: twice the 800 pixels of the saved figure
+RENDER_SIDE = 1600
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.webp')
+# Batch output: one row per detected object, or one row for an image with none (or an error)
+DETECTION_COLUMNS = ['image', 'width', 'height', 'tag', 'probability', 'left', 'top', 'right', 'bottom',
+                     'seconds', 'error']
 
 def main():
     from dotenv import load_dotenv
 
+    parser = argparse.ArgumentParser(description='Detect objects with a Custom Vision model')
+    parser.add_argument('image', nargs='?', default='produce.jpg', help='Image to analyze')
+    parser.add_argument('--threshold', type=float, default=0.5, help='Minimum probability for tags without their own threshold')
+    parser.add_argument('--tag-threshold', action='append', default=[], metavar='TAG=PROBABILITY',
+                        help='Minimum probability for one tag (can be repeated)')
+    parser.add_argument('--iou', type=float, default=0.45, help='Overlap above which boxes of the same tag are merged')
+    parser.add_argument('--tile', type=int, default=0, metavar='PIXELS',
+                        help='Detect on overlapping square tiles of this size (0 sends the whole image)')
+    parser.add_argument('--overlap', type=float, default=0.2, help='Fraction of each tile shared with its neighbours')
+    parser.add_argument('--workers', type=int, default=4, help='Images (or tiles) submitted in parallel')
+    parser.add_argument('--batch', metavar='FOLDER', help='Detect objects in every image in a folder')
+    parser.add_argument('--output', default='detections.csv', help='CSV file for the batch results')
+    parser.add_argument('--draw', metavar='FOLDER', help='Also save the batch images with their boxes drawn')
+    parser.add_argument('--benchmark-nms', action='store_true', help='Time post-processing on 10k synthetic boxes')
+    parser.add_argument('--benchmark-tiles', action='store_true',
+                        help='Compare latency and recall of tile settings on a synthetic shelf photo')
+    args = parser.parse_args()
+
+    if args.benchmark_nms:
+        Benchmark_Post_Processing()
+        return
+    if args.benchmark_tiles:
+        Benchmark_Tiling()
+        return
+
     try:
         # Get Configuration Settings
         load_dotenv()
@@ -16,47 +65,546 @@ def main():
         project_id = os.getenv('ProjectID')
         model_name = os.getenv('ModelName')
 
-        # Authenticate a client for the training API
-        credentials = ApiKeyCredentials(in_headers={"Prediction-key": prediction_key})
-        prediction_client = CustomVisionPredictionClient(endpoint=prediction_endpoint, credentials=credentials)
+        # DetectorBackend=onnx runs an exported model locally instead of calling the service
+        if os.getenv('DetectorBackend', 'service').lower() == 'onnx':
+            prediction_client = OnnxDetector(os.getenv('OnnxModel', os.path.join('test-model', 'model.onnx')))
+        else:
+            # Authenticate a client for the training API
+            credentials = ApiKeyCredentials(in_headers={"Prediction-key": prediction_key})
+            prediction_client = CustomVisionPredictionClient(endpoint=prediction_endpoint, credentials=credentials)
+            prediction_client.config.retry_policy.retries = 0  # Retries are handled by the limiter
+            prediction_client.config.keep_alive = True
 
-        # Load image and get height, width and channels
-        image_file = 'produce.jpg'
+        # Keep the objects above their tag's threshold, one box per object
+        thresholds = dict(Parse_Tag_Threshold(value) for value in args.tag_threshold)
+        detect = functools.partial(Detect_Objects, prediction_client, project_id, model_name,
+                                   thresholds=thresholds, default_threshold=args.threshold, iou_threshold=args.iou,
+                                   tile_size=args.tile, overlap=args.overlap, workers=args.workers)
+
+        if args.batch:
+            # Pure inference: images are only decoded if --draw asks for the pictures
+            Detect_Batch(List_Images(args.batch), args.batch, detect, args.output, args.workers, args.draw)
+            return
+
+        # Load the image bytes once; the size comes from the header
+        image_file = args.image
         print('Detecting objects in', image_file)
-        image = Image.open(image_file)
-        h, w, ch = np.array(image).shape
+        image = ImageFile(image_file)
 
         # Detect objects in the test image
-        with open(image_file, mode="rb") as image_data:
-            results = prediction_client.detect_image(project_id, model_name, image_data)
-
-        # Create a figure for the results
-        fig = plt.figure(figsize=(8, 8))
-        plt.axis('off')
+        detections = detect(image)
 
         # Display the image with boxes around each detected object
-        draw = ImageDraw.Draw(image)
-        lineWidth = int(w/100)
-        color = 'magenta'
-        for prediction in results.predictions:
-            # Only show objects with a > 50% probability
-            if (prediction.probability*100) > 50:
-                # Box coordinates and dimensions are proportional - convert to absolutes
-                left = prediction.bounding_box.left * w 
-                top = prediction.bounding_box.top * h 
-                height = prediction.bounding_box.height * h
-                width =  prediction.bounding_box.width * w
-                # Draw the box
-                points = ((left,top), (left+width,top), (left+width,top+height), (left,top+height),(left,top))
-                draw.line(points, fill=color, width=lineWidth)
-                # Add the tag name and probability
-                plt.annotate(prediction.tag_name + ": {0:.2f}%".format(prediction.probability * 100),(left,top), backgroundcolor=color)
-        plt.imshow(image)
         outputfile = 'output.jpg'
-        fig.savefig(outputfile)
+        Draw_Detections(image, detections, outputfile)
         print('Results saved in ', outputfile)
     except Exception as ex:
         print(ex)
 
+
+def Parse_Tag_Threshold(value):
+    tag, probability = value.rsplit('=', 1)
+    return tag, float(probability)
+
+
+#! Image I/O
+class ImageFile:
+    # An image read from disk once. The upload and the renderer share the same
+    # bytes, the size is read from the header, and the pixels are only decoded
+    # when the image is drawn or cut into tiles.
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, mode="rb") as image_data:
+            self.data = image_data.read()
+        self._size = None
+
+    @property
+    def size(self):
+        # (width, height); Image.open only parses the header until the pixels are used
+        if self._size is None:
+            with Image.open(io.BytesIO(self.data)) as image:
+                self._size = image.size
+        return self._size
+
+    def decode(self, max_side=None):
+        # Pixels of the image, optionally no larger than max_side on the long side;
+        # JPEGs are then decoded directly at a reduced scale
+        image = Image.open(io.BytesIO(self.data))
+        if max_side:
+            image.draft('RGB', (max_side, max_side))
+            image.thumbnail((max_side, max_side))
+        image.load()
+        return image
+
+
+def Detect_Objects(prediction_client, project_id, model_name, image, thresholds=None, default_threshold=0.5,
+                   iou_threshold=0.45, tile_size=0, overlap=0.2, workers=4):
+    # Detections for one ImageFile, sending the bytes as they are unless the image
+    # is larger than the tile size
+    width, height = image.size
+    if tile_size and max(width, height) > tile_size:
+        # Detect objects tile by tile, so small objects keep their pixels
+        return Detect_Tiled(prediction_client, project_id, model_name, image.decode(), tile_size, overlap,
+                            workers, thresholds, default_threshold, iou_threshold)
+    results = Detect_Image(prediction_client, project_id, model_name, image.data)
+    return Post_Process(results.predictions, width, height, thresholds, default_threshold, iou_threshold)
+
+
+def Draw_Detections(image, detections, output_file):
+    # The only place the image is decoded when tiling is off, and only at the
+    # size the figure can show; boxes are scaled to match
+    pixels = image.decode(RENDER_SIDE).convert('RGB')
+    width, height = pixels.size
+    scale = width / image.size[0]
+
+    # Create a figure for the results
+    fig = Figure(figsize=(8, 8))
+    ax = fig.add_subplot()
+    ax.axis('off')
+
+    draw = ImageDraw.Draw(pixels)
+    lineWidth = int(width/100)
+    color = 'magenta'
+    for (left, top, right, bottom), probability, tag in zip((detections.boxes * scale).tolist(),
+                                                            detections.scores.tolist(), detections.tags.tolist()):
+        # Draw the box
+        points = ((left,top), (right,top), (right,bottom), (left,bottom),(left,top))
+        draw.line(points, fill=color, width=lineWidth)
+        # Add the tag name and probability
+        ax.annotate(detections.tag_names[tag] + ": {0:.2f}%".format(probability * 100),(left,top), backgroundcolor=color)
+    ax.imshow(pixels)
+    fig.savefig(output_file)
+
+
+#! Batch
+def List_Images(folder):
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(root, name)
+
+
+def Detection_Rows(image_file, folder, detect, draw_folder=None):
+    # Table rows for one image: one per object, or a single row with the error
+    start = time.perf_counter()
+    name = os.path.relpath(image_file, folder)
+    try:
+        image = ImageFile(image_file)
+        width, height = image.size
+        detections = detect(image)
+        if draw_folder:
+            output_file = os.path.join(draw_folder, os.path.splitext(name)[0] + '.jpg')
+            os.makedirs(os.path.dirname(output_file), exist_ok=True)
+            Draw_Detections(image, detections, output_file)
+    except Exception as ex:
+        return [{'image': name, 'error': str(ex), 'seconds': round(time.perf_counter() - start, 3)}]
+
+    seconds = round(time.perf_counter() - start, 3)
+    rows = [{'image': name, 'width': width, 'height': height, 'tag': detections.tag_names[tag],
+             'probability': round(probability, 4), 'left': round(left, 1), 'top': round(top, 1),
+             'right': round(right, 1), 'bottom': round(bottom, 1), 'seconds': seconds}
+            for (left, top, right, bottom), probability, tag in zip(detections.boxes.tolist(),
+                                                                    detections.scores.tolist(),
+                                                                    detections.tags.tolist())]
+    return rows or [{'image': name, 'width': width, 'height': height, 'seconds': seconds}]
+
+
+def Detect_Batch(image_files, folder, detect, output, workers=4, draw_folder=None):
+    # A bounded number of images in flight, so only their bytes are held in memory;
+    # each result is written to the CSV as soon as it arrives
+    image_files = iter(image_files)
+    pending = set()
+    images = objects = failed = 0
+    start = time.perf_counter()
+
+    with open(output, 'w', newline='', encoding='utf-8') as out, ThreadPoolExecutor(max_workers=workers) as pool:
+        writer = csv.DictWriter(out, fieldnames=DETECTION_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        while True:
+            for image_file in image_files:
+                pending.add(pool.submit(Detection_Rows, image_file, folder, detect, draw_folder))
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                rows = future.result()
+                writer.writerows(rows)
+                images += 1
+                failed += 'error' in rows[0]
+                objects += sum(1 for row in rows if row.get('tag'))
+
+    elapsed = time.perf_counter() - start
+    rate = images / elapsed if elapsed > 0 else 0.0
+    print('{} images, {} objects ({} failed) in {:.2f}s ({:.1f} images/sec)'.format(images, objects, failed, elapsed, rate))
+    print('Results saved in ', output)
+    return images, elapsed
+
+
+#! Post-processing
+def Prediction_Arrays(predictions):
+    # All predictions to arrays in one pass: normalized (left, top, right, bottom) boxes,
+    # probabilities and tag indices into the list of tag names
+    tag_names = sorted({p.tag_name for p in predictions})
+    index = {name: i for i, name in enumerate(tag_names)}
+    values = np.array([(p.bounding_box.left, p.bounding_box.top, p.bounding_box.width, p.bounding_box.height, p.probability)
+                       for p in predictions], dtype=np.float32).reshape(-1, 5)
+    boxes = values[:, :4].copy()
+    boxes[:, 2:] += boxes[:, :2]
+    tags = np.array([index[p.tag_name] for p in predictions], dtype=np.int32)
+    return boxes, values[:, 4], tags, tag_names
+
+
+def Post_Process(predictions, width, height, thresholds=None, default_threshold=0.5, iou_threshold=0.45):
+    boxes, scores, tags, tag_names = Prediction_Arrays(predictions)
+    keep = Above_Threshold(scores, tags, tag_names, thresholds, default_threshold)
+    boxes, scores, tags = boxes[keep], scores[keep], tags[keep]
+
+    keep = Nms(boxes, scores, tags, iou_threshold)
+    boxes = boxes[keep] * np.array([width, height, width, height], dtype=np.float32)
+    return Detections(boxes, scores[keep], tags[keep], tag_names)
+
+
+def Above_Threshold(scores, tags, tag_names, thresholds=None, default_threshold=0.5):
+    # Per-tag thresholds as a lookup table indexed by tag
+    table = np.array([(thresholds or {}).get(name, default_threshold) for name in tag_names], dtype=np.float32)
+    return scores > table[tags]
+
+
+def Nms(boxes, scores, tags, iou_threshold=0.45):
+    # Class-aware non-maximum suppression: indices of the boxes to keep, best first.
+    # Each tag is suppressed separately, so each pass only compares boxes of one tag.
+    keep = [index[Nms_Single(boxes[index], scores[index], iou_threshold)] for index in
+            (np.flatnonzero(tags == tag) for tag in np.unique(tags))]
+    keep = np.concatenate(keep) if keep else np.zeros(0, dtype=np.int64)
+    return keep[np.argsort(-scores[keep], kind='stable')]
+
+
+def Nms_Single(boxes, scores, iou_threshold):
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1) * (y2 - y1)
+    order = np.argsort(-scores, kind='stable')
+    keep = []
+    while len(order):
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        w = np.clip(np.minimum(x2[best], x2[rest]) - np.maximum(x1[best], x1[rest]), 0, None)
+        h = np.clip(np.minimum(y2[best], y2[rest]) - np.maximum(y1[best], y1[rest]), 0, None)
+        inter = w * h
+        iou = inter / (areas[best] + areas[rest] - inter + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+
+def Benchmark_Post_Processing(count=10000, objects=500, width=4000, height=3000, repeat=5):
+    # Synthetic results: clusters of overlapping boxes around random objects, as the
+    # service returns them for crowded shelves
+    rng = np.random.default_rng(0)
+    tag_names = ['apple', 'banana', 'orange']
+    centers = rng.uniform(0.05, 0.95, (objects, 2))
+    sizes = rng.uniform(0.01, 0.05, (objects, 2))
+    object_tags = rng.integers(0, len(tag_names), objects)
+    pick = rng.integers(0, objects, count)
+    jitter = rng.normal(0, 0.05, (count, 4)) * np.tile(sizes[pick], 2)  # A few % of the object's size
+    left_top = centers[pick] - sizes[pick] / 2 + jitter[:, :2]
+    size = sizes[pick] + jitter[:, 2:]
+    predictions = ImagePrediction.from_dict({'predictions': [
+        {'probability': float(score), 'tagName': tag_names[tag],
+         'boundingBox': {'left': float(l), 'top': float(t), 'width': float(w), 'height': float(h)}}
+        for (l, t), (w, h), tag, score in zip(left_top, size, object_tags[pick], rng.uniform(0, 1, count))]}).predictions
+
+    def Loop():
+        # Before: one prediction at a time, fixed threshold, no suppression
+        kept = []
+        for prediction in predictions:
+            if (prediction.probability*100) > 50:
+                left = prediction.bounding_box.left * width
+                top = prediction.bounding_box.top * height
+                kept.append((left, top, left + prediction.bounding_box.width * width,
+                             top + prediction.bounding_box.height * height, prediction.tag_name))
+        return kept
+
+    def Time(fn):
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = fn()
+            best = min(best, time.perf_counter() - start)
+        return best * 1000, result
+
+    loop_ms, loop_boxes = Time(Loop)
+    arrays_ms, (boxes, scores, tags, names) = Time(lambda: Prediction_Arrays(predictions))
+    nms_ms, keep = Time(lambda: Nms(boxes[scores > 0.5], scores[scores > 0.5], tags[scores > 0.5]))
+    total_ms, detections = Time(lambda: Post_Process(predictions, width, height))
+
+    print('Post-processing {} synthetic predictions ({} objects), best of {}'.format(count, objects, repeat))
+    print(' {:<38} {:>9.1f} ms  {:>5} boxes'.format('Per-prediction loop, threshold only', loop_ms, len(loop_boxes)))
+    print(' {:<38} {:>9.1f} ms'.format('To arrays', arrays_ms))
+    print(' {:<38} {:>9.1f} ms  {:>5} boxes'.format('Class-aware NMS', nms_ms, len(keep)))
+    print(' {:<38} {:>9.1f} ms  {:>5} boxes'.format('Vectorized threshold + NMS (total)', total_ms, len(detections.scores)))
+
+
+#! Tiling
+def Tile_Grid(width, height, tile_size=1024, overlap=0.2):
+    # Pixel boxes (left, top, right, bottom) of overlapping tiles covering the image;
+    # the last row and column of tiles are moved back to end at the image edge
+    step = max(1, int(tile_size * (1 - overlap)))
+
+    def Starts(length):
+        if length <= tile_size:
+            return [0]
+        return list(range(0, length - tile_size, step)) + [length - tile_size]
+
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height)) for y in Starts(height) for x in Starts(width)]
+
+
+def Detect_Tiled(prediction_client, project_id, model_name, image, tile_size=1024, overlap=0.2, workers=4,
+                 thresholds=None, default_threshold=0.5, iou_threshold=0.45, seam_threshold=0.6):
+    # Detects objects on overlapping tiles, several tiles at a time, and merges the
+    # results into one set of detections in the image's pixel coordinates.
+    # The overlap should be wider than the largest object, so that every object is
+    # whole in at least one tile.
+    width, height = image.size
+    tiles = Tile_Grid(width, height, tile_size, overlap)
+    image = image.convert('RGB')  # Decoded once, before the threads crop it
+
+    def Detect_Tile(tile):
+        tile_data = io.BytesIO()
+        image.crop(tile).save(tile_data, 'JPEG', quality=90)
+        return Detect_Image(prediction_client, project_id, model_name, tile_data.getvalue())
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(Detect_Tile, tiles))
+
+    # Tile-relative normalized boxes to image pixels, with one list of tag names for all tiles
+    tag_names = sorted({p.tag_name for result in results for p in result.predictions})
+    index = {name: i for i, name in enumerate(tag_names)}
+    parts = []
+    for number, ((left, top, right, bottom), result) in enumerate(zip(tiles, results)):
+        boxes, scores, tags, names = Prediction_Arrays(result.predictions)
+        scale = np.array([right - left, bottom - top] * 2, dtype=np.float32)
+        offset = np.array([left, top] * 2, dtype=np.float32)
+        tags = np.array([index[name] for name in names], dtype=np.int32)[tags]
+        parts.append((boxes * scale + offset, scores, tags, np.full(len(scores), number)))
+    boxes, scores, tags, tile_index = (np.concatenate(column) for column in zip(*parts))
+
+    keep = Above_Threshold(scores, tags, tag_names, thresholds, default_threshold)
+    boxes, scores, tags = Merge_Tiles(boxes[keep], scores[keep], tags[keep], tile_index[keep],
+                                      iou_threshold, seam_threshold)
+    return Detections(boxes, scores, tags, tag_names)
+
+
+def Detect_Image(prediction_client, project_id, model_name, image_data):
+    # Only requests to the service count against its quota; local ONNX inference is not throttled
+    if isinstance(prediction_client, OnnxDetector):
+        return prediction_client.detect_image(project_id, model_name, image_data)
+    return limiter.call(prediction_client.detect_image, project_id, model_name, image_data)
+
+
+def Merge_Tiles(boxes, scores, tags, tile_index, iou_threshold=0.45, seam_threshold=0.6):
+    # Class-aware NMS across tiles that also joins objects cut by a tile edge. A box
+    # from another tile that lies mostly inside the best box (intersection over the
+    # smaller box above seam_threshold) is the same object seen through a seam, and
+    # the kept box grows to cover it, until no more pieces join. seam_threshold=None
+    # only applies NMS. Returns the merged boxes, scores and tags, best first.
+    merged = []
+    for tag in np.unique(tags):
+        index = np.flatnonzero(tags == tag)
+        tag_boxes = boxes[index]
+        areas = (tag_boxes[:, 2] - tag_boxes[:, 0]) * (tag_boxes[:, 3] - tag_boxes[:, 1])
+        order = np.argsort(-scores[index], kind='stable')
+        while len(order):
+            best, rest = order[0], order[1:]
+            box = tag_boxes[best].copy()
+            while seam_threshold is not None and len(rest):
+                inter = Intersection(box, tag_boxes[rest])
+                area = (box[2] - box[0]) * (box[3] - box[1])
+                seam = ((tile_index[index[rest]] != tile_index[index[best]])
+                        & (inter / (np.minimum(area, areas[rest]) + 1e-9) > seam_threshold))
+                if not seam.any():
+                    break
+                pieces = tag_boxes[rest[seam]]
+                box[:2] = np.minimum(box[:2], pieces[:, :2].min(axis=0))
+                box[2:] = np.maximum(box[2:], pieces[:, 2:].max(axis=0))
+                rest = rest[~seam]
+            # Then plain NMS against the (possibly grown) box
+            inter = Intersection(box, tag_boxes[rest])
+            area = (box[2] - box[0]) * (box[3] - box[1])
+            merged.append((*box, scores[index[best]], tag))
+            order = rest[inter / (area + areas[rest] - inter + 1e-9) <= iou_threshold]
+
+    merged = np.array(merged, dtype=np.float32).reshape(-1, 6)
+    merged = merged[np.argsort(-merged[:, 4], kind='stable')]
+    return merged[:, :4], merged[:, 4], merged[:, 5].astype(np.int32)
+
+
+def Intersection(box, boxes):
+    # Area shared by one (left, top, right, bottom) box with each of the others
+    w = np.clip(np.minimum(box[2], boxes[:, 2]) - np.maximum(box[0], boxes[:, 0]), 0, None)
+    h = np.clip(np.minimum(box[3], boxes[:, 3]) - np.maximum(box[1], boxes[:, 1]), 0, None)
+    return w * h
+
+
+def Benchmark_Tiling(width=5472, height=3648, grid=(12, 18), sizes=(16, 160), service_side=512):
+    # A synthetic 20-megapixel shelf photo with a grid of products from 16 to 160
+    # pixels wide, sent to a simulated service that shrinks every request to 512
+    # pixels on its long side before detecting, as the real models do. Small
+    # products only survive the shrink when the image is sent in tiles.
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(195, 206, (height, width, 3), dtype=np.uint8)
+    rows, cols = grid
+    cell_w, cell_h = width / cols, height / rows
+    truth = []
+    for row in range(rows):
+        for col in range(cols):
+            side = rng.uniform(*sizes)
+            cx = (col + 0.5) * cell_w + rng.uniform(-0.1, 0.1) * cell_w
+            cy = (row + 0.5) * cell_h + rng.uniform(-0.1, 0.1) * cell_h
+            left, top = int(cx - side / 2), int(cy - side / 2)
+            right, bottom = left + int(side), top + int(side)
+            pixels[top:bottom, left:right] = (200, 40, 40)
+            truth.append((left, top, right, bottom))
+    truth = np.array(truth, dtype=np.float32)
+    image = Image.fromarray(pixels)
+    whole = io.BytesIO()
+    image.save(whole, 'JPEG', quality=90)
+    service = SimulatedDetector(service_side)
+
+    print('Synthetic {}x{} photo, {} products of {}-{} px, service input {} px, limiter at {}/s'.format(
+        width, height, len(truth), sizes[0], sizes[1], service_side, limiter.rate))
+    print(' {:<28} {:>6} {:>9} {:>8} {:>10}'.format('Mode', 'Calls', 'Latency', 'Recall', 'Precision'))
+    settings = [('Whole image', None, None, None, 0.6),
+                ('2048 px, 20% overlap, 4', 2048, 0.2, 4, 0.6),
+                ('1024 px, 20% overlap, 1', 1024, 0.2, 1, 0.6),
+                ('1024 px, 20% overlap, 4', 1024, 0.2, 4, 0.6),
+                ('1024 px, 20% overlap, 8', 1024, 0.2, 8, 0.6),
+                ('1024 px, 20% overlap, 8, NMS', 1024, 0.2, 8, None),
+                ('768 px, 25% overlap, 8', 768, 0.25, 8, 0.6)]
+    for name, tile_size, overlap, workers, seam_threshold in settings:
+        service.calls = 0
+        start = time.perf_counter()
+        if tile_size is None:
+            results = limiter.call(service.detect_image, None, None, whole.getvalue())
+            detections = Post_Process(results.predictions, width, height)
+        else:
+            detections = Detect_Tiled(service, None, None, image, tile_size, overlap, workers,
+                                      seam_threshold=seam_threshold)
+        elapsed = time.perf_counter() - start
+        matched = Match_Boxes(detections.boxes, truth)
+        print(' {:<28} {:>6} {:>8.2f}s {:>7.1%} {:>10.1%}'.format(
+            name, service.calls, elapsed, matched / len(truth), matched / max(1, len(detections.scores))))
+
+
+def Match_Boxes(boxes, truth, iou_threshold=0.5):
+    # Detections matched one-to-one to a ground truth box with IoU above the threshold
+    inter_w = np.clip(np.minimum(boxes[:, None, 2], truth[None, :, 2]) - np.maximum(boxes[:, None, 0], truth[None, :, 0]), 0, None)
+    inter_h = np.clip(np.minimum(boxes[:, None, 3], truth[None, :, 3]) - np.maximum(boxes[:, None, 1], truth[None, :, 1]), 0, None)
+    inter = inter_w * inter_h
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    truth_areas = (truth[:, 2] - truth[:, 0]) * (truth[:, 3] - truth[:, 1])
+    iou = inter / (areas[:, None] + truth_areas[None, :] - inter + 1e-9)
+    taken = np.zeros(len(truth), dtype=bool)
+    for row in iou:
+        candidates = np.where(taken, 0, row)
+        if len(candidates) and candidates.max() > iou_threshold:
+            taken[candidates.argmax()] = True
+    return int(taken.sum())
+
+
+class SimulatedDetector:
+    # Stand-in for the prediction service in Benchmark_Tiling: shrinks the image to
+    # the model's input size, finds the red products left after the shrink and
+    # answers after a network delay that grows with the request size.
+
+    def __init__(self, input_side=512, min_side=6, latency=0.2, bandwidth=4e6):
+        self.input_side = input_side
+        self.min_side = min_side    # Smallest object, in model input pixels, the model still finds
+        self.latency = latency      # Seconds per request
+        self.bandwidth = bandwidth  # Upload bytes per second
+        self.calls = 0
+
+    def detect_image(self, project_id, published_name, image_data):
+        self.calls += 1
+        time.sleep(self.latency + len(image_data) / self.bandwidth)
+        image = Image.open(io.BytesIO(image_data))
+        image.thumbnail((self.input_side, self.input_side), Image.BOX)
+        mask = np.asarray(image)[:, :, 1] < 120
+        height, width = mask.shape
+
+        # Products sit on a grid: each pair of row and column runs holds at most one
+        predictions = []
+        for top, bottom in self.runs(mask.any(axis=1)):
+            for left, right in self.runs(mask[top:bottom].any(axis=0)):
+                cell = mask[top:bottom, left:right]
+                ys, xs = np.flatnonzero(cell.any(axis=1)), np.flatnonzero(cell.any(axis=0))
+                if len(ys) < self.min_side or len(xs) < self.min_side:
+                    continue
+                predictions.append({'probability': 0.9, 'tagName': 'product', 'boundingBox': {
+                    'left': (left + xs[0]) / width, 'top': (top + ys[0]) / height,
+                    'width': len(xs) / width, 'height': len(ys) / height}})
+        return ImagePrediction.from_dict({'predictions': predictions})
+
+    @staticmethod
+    def runs(flags):
+        # (start, end) of each run of True values
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], flags.astype(np.int8), [0]))))
+        return edges.reshape(-1, 2).tolist()
+
+
+class OnnxDetector:
+    # Runs a Custom Vision object detection model exported as ONNX (compact domain)
+    # on the CPU. detect_image takes the same arguments as the prediction client and
+    # returns the same ImagePrediction, so the rest of the script does not change.
+    # labels.txt from the export must be next to the model file.
+
+    def __init__(self, model_file):
+        import onnxruntime  # Only needed for local inference
+
+        self.session = onnxruntime.InferenceSession(model_file, providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.input_size = (model_input.shape[3], model_input.shape[2])  # (width, height)
+        self.input_type = np.float16 if model_input.type == 'tensor(float16)' else np.float32
+        self.output_names = [output.name for output in self.session.get_outputs()]
+
+        # The export records the channel order and pixel range it expects
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.bgr = metadata.get('Image.BitmapPixelFormat') == 'Bgr8'
+        self.range255 = metadata.get('Image.NominalPixelRange') == 'NominalRange_0_255'
+
+        with open(os.path.join(os.path.dirname(model_file), 'labels.txt')) as labels_file:
+            self.labels = [line.strip() for line in labels_file if line.strip()]
+
+    def preprocess(self, image_data):
+        # Image bytes -> (1, 3, H, W) tensor in the model's channel order and range
+        image = Image.open(io.BytesIO(image_data))
+        image.draft('RGB', self.input_size)  # JPEG: decode at the smallest scale still above the input size
+        image = image.convert('RGB').resize(self.input_size)
+        tensor = np.asarray(image, dtype=np.float32).transpose(2, 0, 1)[np.newaxis]
+        if self.bgr:
+            tensor = tensor[:, ::-1]
+        if not self.range255:
+            tensor = tensor / 255
+        return np.ascontiguousarray(tensor, dtype=self.input_type)
+
+    def detect_image(self, project_id, published_name, image_data):
+        if hasattr(image_data, 'read'):
+            image_data = image_data.read()
+        outputs = dict(zip(self.output_names, self.session.run(self.output_names, {self.input_name: self.preprocess(image_data)})))
+
+        # Boxes come back as normalized (x1, y1, x2, y2); the service uses left, top, width, height
+        predictions = []
+        for (x1, y1, x2, y2), tag, probability in zip(outputs['detected_boxes'][0].tolist(),
+                                                      outputs['detected_classes'][0].tolist(),
+                                                      outputs['detected_scores'][0].tolist()):
+            predictions.append({'probability': probability, 'tagName': self.labels[int(tag)],
+                                'boundingBox': {'left': x1, 'top': y1, 'width': x2 - x1, 'height': y2 - y1}})
+        return ImagePrediction.from_dict({'iteration': published_name, 'predictions': predictions})
+
+
 if __name__ == "__main__":
     main()
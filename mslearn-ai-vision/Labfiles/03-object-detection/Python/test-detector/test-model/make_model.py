@@ -0,0 +1,41 @@
+# Builds the tiny ONNX model used to try the local backend without a real export.
+#
+# It has the same interface as a Custom Vision compact object detection export
+# (input image_tensor, outputs detected_boxes / detected_classes / detected_scores)
+# but no weights: it always returns the same three boxes, and the score of each
+# box is the mean of one colour channel of the input, so preprocessing mistakes
+# (channel order, pixel range) show up in the scores.
+#
+#   pip install onnx
+#   python make_model.py
+import numpy as np
+import onnx
+from onnx import helper, numpy_helper, TensorProto
+
+SIZE = 320
+BOXES = np.array([[[0.05, 0.10, 0.35, 0.50],    # apple
+                   [0.40, 0.20, 0.90, 0.60],    # banana
+                   [0.55, 0.55, 0.85, 0.95]]],  # orange
+                 dtype=np.float32)
+CLASSES = np.array([[0, 1, 2]], dtype=np.int64)
+
+nodes = [
+    helper.make_node('ReduceMean', ['image_tensor'], ['detected_scores'], axes=[2, 3], keepdims=0),
+    helper.make_node('Constant', [], ['detected_boxes'], value=numpy_helper.from_array(BOXES)),
+    helper.make_node('Constant', [], ['detected_classes'], value=numpy_helper.from_array(CLASSES)),
+]
+graph = helper.make_graph(
+    nodes, 'custom-vision-test-model',
+    [helper.make_tensor_value_info('image_tensor', TensorProto.FLOAT, [1, 3, SIZE, SIZE])],
+    [helper.make_tensor_value_info('detected_boxes', TensorProto.FLOAT, [1, 3, 4]),
+     helper.make_tensor_value_info('detected_classes', TensorProto.INT64, [1, 3]),
+     helper.make_tensor_value_info('detected_scores', TensorProto.FLOAT, [1, 3])])
+
+model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)], producer_name='make_model.py')
+model.ir_version = 7
+helper.set_model_props(model, {'Image.BitmapPixelFormat': 'Rgb8', 'Image.NominalPixelRange': 'Normalized_0_1'})
+onnx.checker.check_model(model)
+onnx.save(model, 'model.onnx')
+
+with open('labels.txt', 'w') as labels:
+    labels.write('apple\nbanana\norange\n')
@@ -1,15 +1,43 @@
 from azure.cognitiveservices.vision.customvision.training import CustomVisionTrainingClient
-from azure.cognitiveservices.vision.customvision.training.models import ImageFileCreateBatch, ImageFileCreateEntry, Region
+from azure.cognitiveservices.vision.customvision.training.models import Region
 from msrest.authentication import ApiKeyCredentials
+import argparse
 import time
 import json
 import os
+import numpy as np
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Shared limiter with retries on 429 for every training API call
+from rate_limiter import RateLimiter
+# Local record of what is already in the project, so re-runs only upload changes
+from upload_manifest import UploadManifest
+# Batching, result matching and per-image retries shared with the classifier lab
+from batch_upload import Image_Batches, Upload_Batch
+
+limiter = RateLimiter(rate=10)
+
+MANIFEST_FILE = 'upload-manifest.jsonl'
+
+# Regions from tagged-images.json in columnar form: one entry per region, with the
+# index of its file, the index of its tag name and its (left, top, width, height) box
+Annotations = namedtuple('Annotations', ['files', 'tag_names', 'file_index', 'tag_index', 'boxes'])
 
 def main():
     from dotenv import load_dotenv
     global training_client
     global custom_vision_project
 
+    parser = argparse.ArgumentParser(description='Upload tagged images to a Custom Vision object detection project')
+    parser.add_argument('folder', nargs='?', default='images', help='Folder with the images in tagged-images.json')
+    parser.add_argument('--workers', type=int, default=4, help='Batches uploaded in parallel')
+    parser.add_argument('--annotations', default='tagged-images.json', help='JSON file with the tagged regions')
+    parser.add_argument('--no-create-tags', action='store_true', help='Treat tags missing from the project as errors')
+    parser.add_argument('--skip-invalid', action='store_true', help='Upload without the invalid regions instead of stopping')
+    parser.add_argument('--manifest', default=MANIFEST_FILE, help='Record of the images already uploaded')
+    args = parser.parse_args()
+
     try:
         # Get Configuration Settings
         load_dotenv()
@@ -20,53 +48,168 @@ def main():
         # Authenticate a client for the training API
         credentials = ApiKeyCredentials(in_headers={"Training-key": training_key})
         training_client = CustomVisionTrainingClient(training_endpoint, credentials)
+        training_client.config.retry_policy.retries = 0  # Retries are handled by the limiter
+        training_client.config.keep_alive = True
 
         # Get the Custom Vision project
         custom_vision_project = training_client.get_project(project_id)
 
         # Upload and tag images
-        Upload_Images('images')
+        Upload_Images(args.folder, workers=args.workers, annotations_file=args.annotations,
+                      create_tags=not args.no_create_tags, skip_invalid=args.skip_invalid,
+                      manifest_file=args.manifest)
     except Exception as ex:
         print(ex)
 
 
 
-def Upload_Images(folder):
+def Upload_Images(folder, workers=4, annotations_file='tagged-images.json', create_tags=True, skip_invalid=False,
+                  manifest_file=MANIFEST_FILE):
+    # Check every region before anything is uploaded
+    annotations = Load_Annotations(annotations_file)
+    valid, present, errors = Validate_Annotations(annotations, folder)
+
+    # Get the tags defined in the project (indexed by name once)
+    tag_ids = {tag.name: tag.id for tag in training_client.get_tags(custom_vision_project.id)}
+    known = np.array([name in tag_ids for name in annotations.tag_names], dtype=bool)[annotations.tag_index]
+    missing = [annotations.tag_names[i] for i in np.unique(annotations.tag_index[valid & ~known])]
+    if not create_tags:
+        errors += Region_Errors(annotations, valid & ~known, 'unknown tag')
+        valid &= known
+
+    if errors:
+        Print_Errors(errors)
+        if not skip_invalid:
+            print("Nothing uploaded; fix the annotations or use --skip-invalid.")
+            return
+        print("Skipping the invalid regions and missing images.")
+
+    if missing:
+        Create_Tags(missing, tag_ids)
+
     print("Uploading images...")
 
-    # Get the tags defined in the project
-    tags = training_client.get_tags(custom_vision_project.id)
+    # Upload the images in batches of up to 64, several batches at a time.
+    # Batches are built from a generator as workers become free, so only the
+    # images of the batches in flight are held in memory.
+    # Images already in the project with the same content and regions are skipped.
+    manifest = UploadManifest(manifest_file, custom_vision_project.id)
+    counts = {'unchanged': 0}
+    batches = Image_Batches(Tagged_Images(folder, annotations, tag_ids, valid, present), manifest, counts)
+    pending = set()
+    uploaded = duplicates = 0
+    failed = []
+    start = time.perf_counter()
 
-    # Create a list of images with tagged regions
-    tagged_images_with_regions = []
+    with manifest, ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            for batch in batches:
+                pending.add(pool.submit(Upload_Batch, training_client, custom_vision_project.id, limiter, batch, manifest))
+                if len(pending) >= workers:
+                    break
+            if not pending:
+                break
 
-    # Get the images and tagged regions from the JSON file
-    with open('tagged-images.json', 'r') as json_file:
-        tagged_images = json.load(json_file)
-        for image in tagged_images['files']:
-            # Get the filename
-            file = image['filename']
-            # Get the tagged regions
-            regions = []
-            for tag in image['tags']:
-                tag_name = tag['tag']
-                # Look up the tag ID for this tag name
-                tag_id = next(t for t in tags if t.name == tag_name).id
-                # Add a region for this tag using the coordinates and dimensions in the JSON
-                regions.append(Region(tag_id=tag_id, left=tag['left'],top=tag['top'],width=tag['width'],height=tag['height']))
-            # Add the image and its regions to the list
-            with open(os.path.join(folder,file), mode="rb") as image_data:
-                tagged_images_with_regions.append(ImageFileCreateEntry(name=file, contents=image_data.read(), regions=regions))
-
-    # Upload the list of images as a batch
-    upload_result = training_client.create_images_from_files(custom_vision_project.id, ImageFileCreateBatch(images=tagged_images_with_regions))
-    # Check for failure
-    if not upload_result.is_batch_successful:
-        print("Image batch upload failed.")
-        for image in upload_result.images:
-            print("Image status: ", image.status)
-    else:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results = future.result()
+                uploaded += sum(1 for name, status in results if status == 'OK')
+                duplicates += sum(1 for name, status in results if status == 'OKDuplicate')
+                failed += [(name, status) for name, status in results if not status.startswith('OK')]
+
+    elapsed = time.perf_counter() - start
+    print("{} images uploaded, {} duplicates, {} failed, {} unchanged in {:.1f}s".format(
+        uploaded, duplicates, len(failed), counts['unchanged'], elapsed))
+    for name, status in failed:
+        print("Image status: ", name, status)
+    if not failed:
         print("Images uploaded.")
 
+
+def Load_Annotations(path):
+    # Reads the JSON file once into flat arrays
+    with open(path, 'r') as json_file:
+        tagged_images = json.load(json_file)
+
+    files, file_index, names, boxes = [], [], [], []
+    for index, image in enumerate(tagged_images['files']):
+        files.append(image['filename'])
+        for tag in image['tags']:
+            file_index.append(index)
+            names.append(tag['tag'])
+            boxes.append((tag['left'], tag['top'], tag['width'], tag['height']))
+
+    tag_names, tag_index = np.unique(np.array(names, dtype=str), return_inverse=True)
+    return Annotations(files, tag_names.tolist(),
+                       np.array(file_index, dtype=np.int64),
+                       tag_index.astype(np.int64).reshape(-1),
+                       np.array(boxes, dtype=np.float64).reshape(-1, 4))
+
+
+def Validate_Annotations(annotations, folder):
+    # Returns a mask of the valid regions, a mask of the image files found and the
+    # list of errors, checking all regions at once
+    present = np.array([os.path.exists(os.path.join(folder, file)) for file in annotations.files], dtype=bool)
+    errors = [(file, None, 'image file not found') for file in np.array(annotations.files)[~present]]
+
+    left, top, width, height = annotations.boxes.T
+    checks = [
+        (np.isfinite(annotations.boxes).all(axis=1), 'coordinates are not numbers'),
+        ((left >= 0) & (top >= 0), 'box starts outside the image'),
+        ((width > 0) & (height > 0), 'box has no area'),
+        ((left + width <= 1 + 1e-6) & (top + height <= 1 + 1e-6), 'box ends outside the image'),
+    ]
+    valid = present[annotations.file_index]
+    for passed, reason in checks:
+        errors += Region_Errors(annotations, valid & ~passed, reason)
+        valid &= passed
+    return valid, present, errors
+
+
+def Region_Errors(annotations, mask, reason):
+    # (filename, tag, reason) for each region selected by the mask
+    return [(annotations.files[annotations.file_index[i]], annotations.tag_names[annotations.tag_index[i]], reason)
+            for i in np.flatnonzero(mask)]
+
+
+def Print_Errors(errors, limit=20):
+    print("{} annotation errors:".format(len(errors)))
+    counts = {}
+    for file, tag, reason in errors:
+        counts[reason] = counts.get(reason, 0) + 1
+    for reason, count in sorted(counts.items()):
+        print(" - {}: {}".format(reason, count))
+    for file, tag, reason in errors[:limit]:
+        print("   {}{}: {}".format(file, ' ({})'.format(tag) if tag else '', reason))
+    if len(errors) > limit:
+        print("   ...")
+
+
+def Create_Tags(names, tag_ids):
+    # There is no batch call for tags, so the missing ones are created in parallel
+    print("Creating tags:", ', '.join(names))
+    with ThreadPoolExecutor(max_workers=min(8, len(names))) as pool:
+        for tag in pool.map(lambda name: limiter.call(training_client.create_tag, custom_vision_project.id, name), names):
+            tag_ids[tag.name] = tag.id
+
+
+def Tagged_Images(folder, annotations, tag_ids, valid, present):
+    # Yields (name, path, signature, fields) for each image found, with only its valid
+    # regions; the signature is what the manifest compares to detect changed regions
+    ids = [tag_ids.get(name) for name in annotations.tag_names]
+    order = np.flatnonzero(valid)
+    starts = np.searchsorted(annotations.file_index[order], np.arange(len(annotations.files) + 1))
+    for index, file in enumerate(annotations.files):
+        if not present[index]:
+            continue
+        regions = []
+        for i in order[starts[index]:starts[index + 1]].tolist():
+            left, top, width, height = annotations.boxes[i].tolist()
+            regions.append(Region(tag_id=ids[annotations.tag_index[i]], left=left, top=top, width=width, height=height))
+        signature = sorted([r.tag_id, round(r.left, 6), round(r.top, 6), round(r.width, 6), round(r.height, 6)]
+                           for r in regions)
+        yield file, os.path.join(folder, file), signature, {'regions': regions}
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
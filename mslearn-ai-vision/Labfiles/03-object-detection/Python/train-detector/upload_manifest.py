@@ -0,0 +1,80 @@
+# Local record of the images already uploaded to a Custom Vision project.
+#
+# Every uploaded image is appended to a JSON Lines file as soon as the service
+# confirms it: project, image name, content hash, Custom Vision image ID and the
+# tags (or regions) it was uploaded with. A re-run only uploads images that are
+# new or whose content or tags changed, and an interrupted upload resumes after
+# the last confirmed batch. Later lines win over earlier ones for the same name.
+import hashlib
+import json
+import os
+import threading
+
+
+def ContentHash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class UploadManifest:
+
+    def __init__(self, path, project_id):
+        self.path = path
+        self.project_id = str(project_id)
+        self.entries = {}  # name -> {'hash', 'image_id', 'tags'}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Line cut short by an interrupted run
+                    if record.get('project') != self.project_id:
+                        continue
+                    if record.get('image_id') is None:
+                        self.entries.pop(record['name'], None)
+                    else:
+                        self.entries[record['name']] = record
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def status(self, name, content_hash, tags):
+        # 'new', 'current' (nothing to do) or 'changed' (the old image must be replaced)
+        entry = self.entries.get(name)
+        if entry is None:
+            return 'new'
+        if entry['hash'] == content_hash and entry['tags'] == tags:
+            return 'current'
+        return 'changed'
+
+    def image_id(self, name):
+        entry = self.entries.get(name)
+        return entry['image_id'] if entry else None
+
+    def record(self, name, content_hash, image_id, tags):
+        self._write({'project': self.project_id, 'name': name, 'hash': content_hash,
+                     'image_id': image_id, 'tags': tags})
+
+    def forget(self, name):
+        self._write({'project': self.project_id, 'name': name, 'image_id': None})
+
+    def _write(self, record):
+        with self._lock:
+            if record['image_id'] is None:
+                self.entries.pop(record['name'], None)
+            else:
+                self.entries[record['name']] = record
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
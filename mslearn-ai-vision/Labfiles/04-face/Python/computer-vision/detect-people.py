@@ -1,94 +1,333 @@
 from dotenv import load_dotenv  # Importa la función load_dotenv desde la biblioteca dotenv
 import os  # Importa el módulo os para interactuar con el sistema operativo
-from array import array  # Importa el tipo de datos array desde la biblioteca array
 from PIL import Image, ImageDraw  # Importa las clases Image y ImageDraw del módulo PIL (Python Imaging Library)
-import sys  # Importa el módulo sys para interactuar con el intérprete de Python
 import time  # Importa el módulo time para manejar el tiempo
+import argparse  # Argumentos de línea de comandos (imagen, carpeta y umbral)
+import csv  # Salida por lotes: una fila por persona
+from collections import deque  # Ventana de fotogramas en curso del modo vídeo
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED  # Hilos que comparten un único cliente
 from matplotlib import pyplot as plt  # Importa el módulo pyplot de la biblioteca matplotlib para trazar gráficos
 import numpy as np  # Importa el módulo numpy para realizar cálculos numéricos
 
 # Importa el espacio de nombres necesario para interactuar con Azure AI Vision
-import azure.ai.vision as sdk  
+from azure.ai.vision.imageanalysis import ImageAnalysisClient
+from azure.ai.vision.imageanalysis.models import VisualFeatures
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
+
+# Limitador de peticiones compartido con reintentos ante respuestas 429
+from rate_limiter import RateLimiter
+
+# Todas las llamadas a Vision pasan por el limitador (los reintentos los maneja él, no azure-core)
+limiter = RateLimiter(rate=10)
+
+# Columnas de la tabla de resultados por lotes (una fila por persona)
+PEOPLE_COLUMNS = ['image', 'person', 'x', 'y', 'w', 'h', 'confidence', 'elapsed_ms', 'error']
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.webp')
+
+# Columnas de la serie temporal del modo vídeo (una fila por segundo)
+SERIES_COLUMNS = ['second', 'people', 'sampled_frames', 'analyzed_frames']
 
 # Define la función principal del programa
 def main():
     global cv_client  # Declara una variable global cv_client
 
+    # Una imagen (por defecto images/people.jpg) o una carpeta completa con --batch
+    parser = argparse.ArgumentParser(description='Detectar personas con Azure AI Vision')
+    parser.add_argument('image', nargs='?', default='images/people.jpg', help='Imagen a analizar')
+    parser.add_argument('--batch', help='Carpeta con las imágenes a analizar')
+    parser.add_argument('--video', help='Vídeo en el que contar personas por segundo')
+    parser.add_argument('--output', help='Archivo CSV de salida (people.csv o people-video.csv)')
+    parser.add_argument('--workers', type=int, default=8, help='Número de hilos que llaman al servicio')
+    parser.add_argument('--threshold', type=float, default=0.5, help='Confianza mínima de una persona')
+    parser.add_argument('--sample-fps', type=float, default=2.0, help='Fotogramas por segundo que se examinan')
+    parser.add_argument('--changed-cells', type=int, default=4,
+                        help='Celdas de la firma que deben cambiar para volver a analizar un fotograma')
+    parser.add_argument('--refresh', type=float, default=30.0,
+                        help='Segundos máximos sin analizar aunque la escena no cambie')
+    args = parser.parse_args()
+
     try:
         # Carga la configuración desde un archivo .env
         load_dotenv()
         ai_endpoint = os.getenv('AI_SERVICE_ENDPOINT')  # Obtiene el punto de conexión del servicio de AI desde las variables de entorno
         ai_key = os.getenv('AI_SERVICE_KEY')  # Obtiene la clave del servicio de AI desde las variables de entorno
 
-        # Obtiene la ruta de la imagen a analizar
-        image_file = 'images/people.jpg'  # Define una ruta de imagen predeterminada
-        if len(sys.argv) > 1:  # Si se proporciona una ruta de imagen como argumento en la línea de comandos, la usa en lugar de la predeterminada
-            image_file = sys.argv[1]
+        # Autentica el cliente de Azure AI Vision (uno solo para todas las imágenes)
+        cv_client = ImageAnalysisClient(
+            endpoint=ai_endpoint,
+            credential=AzureKeyCredential(ai_key),
+            retry_total=0  # Los reintentos los hace el limitador
+        )
+
+        # Modo vídeo: serie temporal de personas por segundo
+        if args.video:
+            CountPeopleVideo(args.video, cv_client, args.output or 'people-video.csv', workers=args.workers,
+                             threshold=args.threshold, sample_fps=args.sample_fps,
+                             min_changed=args.changed_cells, refresh=args.refresh)
+            return
+
+        # Modo por lotes: todas las imágenes de la carpeta con el mismo cliente
+        if args.batch:
+            DetectPeopleBatch(ListImages(args.batch), cv_client, args.output or 'people.csv',
+                              workers=args.workers, threshold=args.threshold)
+            return
 
-        # Autentica el cliente de Azure AI Vision
-        cv_client = sdk.VisionServiceOptions(ai_endpoint, ai_key)
-        
         # Analiza la imagen
-        AnalyzeImage(image_file, cv_client)
+        AnalyzeImage(args.image, cv_client, args.threshold)
 
     except Exception as ex:  # Captura cualquier excepción que ocurra y la imprime
         print(ex)
 
 
-# Define la función para analizar la imagen
-def AnalyzeImage(image_file, cv_client):
-    print('\nAnalyzing', image_file)
+# Llama a Vision con la característica PEOPLE para los bytes de una imagen
+def GetPeople(image_data, cv_client):
+    return limiter.call(cv_client.analyze, image_data=image_data, visual_features=[VisualFeatures.PEOPLE])
 
-    # Especifica las características a recuperar (en este caso, PEOPLE)
-    analysis_options = sdk.ImageAnalysisOptions()
-        
-    features = analysis_options.features = (
-        sdk.ImageAnalysisFeature.PEOPLE  # Establece la característica a analizar como PEOPLE (personas)
-    )    
 
+# Personas del resultado como arreglos: cajas (n, 4) en x, y, w, h y confianzas (n,),
+# ya filtradas por el umbral en una sola operación
+def PeopleArrays(result, threshold=0.5):
+    people = result.people.list if result.people is not None else []
+    boxes = np.array([(p.bounding_box.x, p.bounding_box.y, p.bounding_box.width, p.bounding_box.height)
+                      for p in people], dtype=np.int32).reshape(-1, 4)
+    confidence = np.array([p.confidence for p in people], dtype=np.float32)
+    keep = confidence > threshold
+    return boxes[keep], confidence[keep]
+
+
+# Define la función para analizar la imagen
+def AnalyzeImage(image_file, cv_client, threshold=0.5):
+    print('\nAnalyzing', image_file)
 
     # Obtiene el análisis de la imagen
-    image = sdk.VisionSource(image_file)  # Crea un objeto de origen de imagen desde el archivo de imagen
-    image_analyzer = sdk.ImageAnalyzer(cv_client, image, analysis_options)  # Crea un analizador de imagen
-    result = image_analyzer.analyze()  # Realiza el análisis de la imagen
-    
-    if result.reason == sdk.ImageAnalysisResultReason.ANALYZED:  # Si la imagen se analizó correctamente
-        # Obtiene las personas en la imagen
-        if result.people is not None:
-            print("\nPeople in image:")  # Imprime un encabezado
-            
-            # Prepara la imagen para dibujar
-            image = Image.open(image_file)  # Abre la imagen usando PIL
-            fig = plt.figure(figsize=(image.width/100, image.height/100))  # Crea una figura de matplotlib
-            plt.axis('off')  # Desactiva los ejes en la trama
-            draw = ImageDraw.Draw(image)  # Crea un objeto de dibujo en la imagen
-            color = 'cyan'  # Define el color para dibujar los cuadros delimitadores
-            
-            # Itera sobre cada persona detectada
-            for detected_people in result.people:
-                # Dibuja el cuadro delimitador de la persona si la confianza es mayor al 50%
-                if detected_people.confidence > 0.5:
-                    # Dibuja el cuadro delimitador de la persona
-                    r = detected_people.bounding_box
-                    bounding_box = ((r.x, r.y), (r.x + r.w, r.y + r.h))  # Define las coordenadas del cuadro delimitador
-                    draw.rectangle(bounding_box, outline=color, width=3)  # Dibuja el cuadro delimitador en la imagen
-                    
-                    # Imprime la confianza de la persona detectada
-                    print(" {} (confidence: {:.2f}%)".format(detected_people.bounding_box, detected_people.confidence * 100))
-                        
-            # Guarda la imagen con las personas detectadas
-            plt.imshow(image)  # Muestra la imagen con las personas detectadas
-            plt.tight_layout(pad=0)  # Ajusta el diseño de la trama
-            outputfile = 'detected_people.jpg'  # Nombre del archivo de salida
-            fig.savefig(outputfile)  # Guarda la imagen con las personas detectadas
-            print('  Results saved in', outputfile)  # Imprime un mensaje indicando dónde se guardaron los resultados
-        
-    else:  # Si el análisis falla
-        error_details = sdk.ImageAnalysisErrorDetails.from_result(result)  # Obtiene los detalles del error
+    with open(image_file, 'rb') as f:
+        image_data = f.read()
+    try:
+        result = GetPeople(image_data, cv_client)
+    except HttpResponseError as e:  # Si el análisis falla
         print(" Analysis failed.")  # Imprime un mensaje de error
-        print("   Error reason: {}".format(error_details.reason))  # Imprime la razón del error
-        print("   Error code: {}".format(error_details.error_code))  # Imprime el código de error
-        print("   Error message: {}".format(error_details.message))  # Imprime el mensaje de error
+        print("   Error code: {}".format(e.error.code if e.error else e.status_code))  # Imprime el código de error
+        print("   Error message: {}".format(e.error.message if e.error else e.message))  # Imprime el mensaje de error
+        return
+
+    # Obtiene las personas en la imagen
+    boxes, confidence = PeopleArrays(result, threshold)
+    print("\nPeople in image:")  # Imprime un encabezado
+
+    # Prepara la imagen para dibujar
+    image = Image.open(image_file)  # Abre la imagen usando PIL
+    fig = plt.figure(figsize=(image.width/100, image.height/100))  # Crea una figura de matplotlib
+    plt.axis('off')  # Desactiva los ejes en la trama
+    draw = ImageDraw.Draw(image)  # Crea un objeto de dibujo en la imagen
+    color = 'cyan'  # Define el color para dibujar los cuadros delimitadores
+
+    # Dibuja el cuadro delimitador de cada persona que supera el umbral
+    for (x, y, w, h), score in zip(boxes.tolist(), confidence.tolist()):
+        draw.rectangle(((x, y), (x + w, y + h)), outline=color, width=3)  # Dibuja el cuadro delimitador en la imagen
+        print(" {{x: {}, y: {}, w: {}, h: {}}} (confidence: {:.2f}%)".format(x, y, w, h, score * 100))  # Imprime la confianza
+
+    # Guarda la imagen con las personas detectadas
+    plt.imshow(image)  # Muestra la imagen con las personas detectadas
+    plt.tight_layout(pad=0)  # Ajusta el diseño de la trama
+    outputfile = 'detected_people.jpg'  # Nombre del archivo de salida
+    fig.savefig(outputfile)  # Guarda la imagen con las personas detectadas
+    plt.close(fig)
+    print('  Results saved in', outputfile)  # Imprime un mensaje indicando dónde se guardaron los resultados
+
+
+#! Modo por lotes
+# Imágenes de una carpeta (incluidas subcarpetas), en orden
+def ListImages(folder):
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(root, name)
+
+
+# Filas de la tabla para una imagen: una por persona, o una sola fila con el error
+def PeopleRows(image_file, cv_client, threshold):
+    start = time.perf_counter()
+    try:
+        with open(image_file, 'rb') as f:
+            result = GetPeople(f.read(), cv_client)
+    except Exception as ex:
+        return [{'image': image_file, 'error': str(ex), 'elapsed_ms': round((time.perf_counter() - start) * 1000, 1)}]
+
+    elapsed_ms = round((time.perf_counter() - start) * 1000, 1)
+    boxes, confidence = PeopleArrays(result, threshold)
+    rows = [{'image': image_file, 'person': n, 'x': x, 'y': y, 'w': w, 'h': h,
+             'confidence': round(score, 4), 'elapsed_ms': elapsed_ms}
+            for n, ((x, y, w, h), score) in enumerate(zip(boxes.tolist(), confidence.tolist()), start=1)]
+    return rows or [{'image': image_file, 'person': 0, 'elapsed_ms': elapsed_ms}]  # Imagen sin personas
+
+
+def DetectPeopleBatch(image_files, cv_client, output, workers=8, threshold=0.5):
+    # Las imágenes se envían con un número acotado de peticiones en curso y cada
+    # resultado se escribe en el CSV en cuanto llega
+    image_files = iter(image_files)
+    pending = set()
+    images = people = failed = 0
+    start = time.perf_counter()
+
+    with open(output, 'w', newline='', encoding='utf-8') as out, ThreadPoolExecutor(max_workers=workers) as pool:
+        writer = csv.DictWriter(out, fieldnames=PEOPLE_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        while True:
+            for image_file in image_files:
+                pending.add(pool.submit(PeopleRows, image_file, cv_client, threshold))
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                rows = future.result()
+                writer.writerows(rows)
+                images += 1
+                failed += 'error' in rows[0]
+                people += sum(1 for row in rows if row.get('person'))
+
+    elapsed = time.perf_counter() - start
+    rate = images / elapsed if elapsed > 0 else 0.0
+    print('{} images, {} people ({} failed) in {:.2f}s ({:.1f} images/sec)'.format(images, people, failed, elapsed, rate))
+    print('  Results saved in', output)
+    return images, elapsed
+
+
+#! Modo vídeo
+# Fotogramas muestreados de un vídeo, decodificados bajo demanda: (segundo, fotograma BGR).
+# Los fotogramas que no se muestrean solo se avanzan con grab(), sin decodificarlos a imagen.
+def IterFrames(video, sample_fps=2.0):
+    import cv2  # Solo se necesita para vídeo
+
+    capture = cv2.VideoCapture(video)
+    if not capture.isOpened():
+        raise OSError('Cannot open video {}'.format(video))
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        step = max(1, int(round(fps / sample_fps)))
+        index = 0
+        while capture.grab():
+            if index % step == 0:
+                ok, frame = capture.retrieve()
+                if not ok:
+                    break
+                yield index / fps, frame
+            index += 1
+    finally:
+        capture.release()
+
+
+# Firma perceptual barata: miniatura en grises de 32x32 celdas (media de cada bloque).
+# Se prefiere a un dHash porque el ruido del sensor en zonas planas cambia los bits de
+# gradiente, mientras que la media de un bloque solo se mueve si algo entra en él
+def FrameSignature(frame, size=32):
+    import cv2
+
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+# Número de celdas cuyo brillo cambió más que la tolerancia
+def ChangedCells(a, b, tolerance=12):
+    return int((np.abs(a - b) > tolerance).sum())
+
+
+# Cuenta las personas de un fotograma (codificado como JPEG antes de enviarlo)
+def CountPeople(frame, cv_client, threshold):
+    import cv2
+
+    ok, encoded = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if not ok:
+        raise ValueError('Cannot encode frame')
+    boxes, confidence = PeopleArrays(GetPeople(encoded.tobytes(), cv_client), threshold)
+    return len(boxes)
+
+
+# Fotogramas muestreados con su recuento: solo los que cambian respecto al último
+# analizado van al servicio; el resto reutiliza ese recuento, esperando a que llegue.
+# Si ese análisis falló, el fotograma se vuelve a analizar. Devuelve, en orden,
+# (segundo, futuro con el recuento, analizado) con un número acotado de llamadas en curso.
+def SampleCounts(frames, pool, cv_client, threshold, min_changed=4, refresh=30.0, max_in_flight=8):
+    window = deque()
+    in_flight = 0
+    last_signature = last_future = None
+    last_time = None
+    for second, frame in frames:
+        signature = FrameSignature(frame)
+        changed = (last_signature is None or ChangedCells(signature, last_signature) >= min_changed
+                   or second - last_time >= refresh)
+        if not changed:
+            # Antes de reutilizar el recuento hay que saber si el análisis salió bien
+            wait([last_future])
+            changed = last_future.exception() is not None
+        if changed:
+            last_future = pool.submit(CountPeople, frame, cv_client, threshold)
+            last_signature, last_time = signature, second
+            in_flight += 1
+        window.append((second, last_future, changed))
+
+        while in_flight > max_in_flight:
+            item = window.popleft()
+            in_flight -= item[2]
+            wait([item[1]])  # Los errores se recogen al leer el futuro, no aquí
+            yield item
+    while window:
+        item = window.popleft()
+        wait([item[1]])
+        yield item
+
+
+def CountPeopleVideo(video, cv_client, output, workers=8, threshold=0.5, sample_fps=2.0,
+                     min_changed=4, refresh=30.0):
+    # Serie temporal: para cada segundo, el máximo de personas entre sus fotogramas muestreados
+    print('Counting people in', video)
+    start = time.perf_counter()
+    sampled = analyzed = failed = reused = 0
+    current = None
+
+    def Row(bucket):
+        return {'second': bucket[0], 'people': bucket[1], 'sampled_frames': bucket[2], 'analyzed_frames': bucket[3]}
+
+    with open(output, 'w', newline='', encoding='utf-8') as out, ThreadPoolExecutor(max_workers=workers) as pool:
+        writer = csv.DictWriter(out, fieldnames=SERIES_COLUMNS)
+        writer.writeheader()
+        for second, future, changed in SampleCounts(IterFrames(video, sample_fps), pool, cv_client, threshold,
+                                                     min_changed, refresh, max_in_flight=workers):
+            sampled += 1
+            analyzed += changed
+            try:
+                people = future.result()
+            except Exception as ex:
+                # Solo llega aquí el fotograma analizado: los siguientes no reutilizan un fallo
+                failed += 1
+                print(' {:.1f}s: {}'.format(second, ex))
+                continue
+            reused += not changed
+
+            whole = int(second)
+            if current is not None and current[0] != whole:
+                writer.writerow(Row(current))
+                current = None
+            if current is None:
+                current = [whole, people, 0, 0]
+            current[1] = max(current[1], people)
+            current[2] += 1
+            current[3] += changed
+        if current is not None:
+            writer.writerow(Row(current))
+
+    elapsed = time.perf_counter() - start
+    # Solo cuentan como ahorro los fotogramas que reutilizaron un recuento correcto
+    saved = reused / sampled if sampled else 0.0
+    print('{} frames sampled, {} analyzed ({} failed, {:.0%} API calls saved) in {:.2f}s'.format(
+        sampled, analyzed, failed, saved, elapsed))
+    print('  Results saved in', output)
+    return sampled, analyzed
 
 
 # Llama a la función main si este script se ejecuta directamente
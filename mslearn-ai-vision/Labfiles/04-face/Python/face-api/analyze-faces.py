@@ -2,6 +2,15 @@
 from dotenv import load_dotenv
 # Importar el módulo os para acceder a variables de entorno y operar con archivos
 import os
+# Módulos para el modo por lotes: argumentos, CSV, hilos y medición de tiempos
+import argparse
+import csv
+import json
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 # Importar las clases Image y ImageDraw de la biblioteca PIL para trabajar con imágenes
 from PIL import Image, ImageDraw
 # Importar la función pyplot de matplotlib para visualizar imágenes
@@ -12,11 +21,57 @@ from azure.cognitiveservices.vision.face import FaceClient
 from azure.cognitiveservices.vision.face.models import FaceAttributeType
 from msrest.authentication import CognitiveServicesCredentials
 
+# Limitador de peticiones compartido con reintentos ante respuestas 429
+from rate_limiter import RateLimiter
+# Filtro local de calidad (tamaño, nitidez y exposición) previo a cada llamada
+from face_quality import LoadThresholds, SaveThresholds, Prescreen, Calibrate
+
+# Todas las llamadas a Face pasan por el limitador (los reintentos los maneja él, no msrest)
+limiter = RateLimiter(rate=10)
+
+# Características faciales que se recuperan durante la detección
+FACE_FEATURES = [FaceAttributeType.occlusion,
+                 FaceAttributeType.blur,
+                 FaceAttributeType.glasses]
+
+# Columnas de la tabla de resultados por lotes (una fila por cara)
+FACE_COLUMNS = ['image', 'face', 'left', 'top', 'width', 'height',
+                'blur_blur_level', 'blur_value',
+                'occlusion_forehead_occluded', 'occlusion_eye_occluded', 'occlusion_mouth_occluded',
+                'glasses', 'sharpness', 'prescreen', 'elapsed_ms', 'error']
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
+
+# Umbrales del filtro local escritos por --calibrate
+THRESHOLDS_FILE = 'face-quality.json'
+
 # Definir la función principal del programa
 def main():
     global face_client  # Declarar face_client como una variable global
 
+    # Argumentos del modo por lotes (sin argumentos se muestra el menú)
+    parser = argparse.ArgumentParser(description='Detectar caras con Azure AI Face')
+    parser.add_argument('--batch', help='Carpeta con las imágenes a analizar')
+    parser.add_argument('--output', default='faces.csv', help='Archivo CSV con una fila por cara')
+    parser.add_argument('--workers', type=int, default=8, help='Número de hilos que llaman al servicio')
+    parser.add_argument('--benchmark', action='store_true', help='Medir el escalado contra un servidor local simulado')
+    parser.add_argument('--thresholds', default=THRESHOLDS_FILE, help='Umbrales del filtro local de calidad (JSON)')
+    parser.add_argument('--no-prescreen', action='store_true', help='Enviar todas las imágenes sin filtrarlas localmente')
+    parser.add_argument('--rejected', help='Carpeta a la que se copian las imágenes rechazadas, por motivo')
+    parser.add_argument('--calibrate', action='store_true', help='Calibrar el umbral de nitidez con el blur del servicio')
+    parser.add_argument('--prescreen-report', action='store_true', help='Solo aplicar el filtro local y contar las llamadas ahorradas')
+    args = parser.parse_args()
+
     try:
+        if args.benchmark:
+            BenchmarkBatch(args.batch or 'images')
+            return
+
+        thresholds = None if args.no_prescreen else LoadThresholds(args.thresholds)
+        if args.prescreen_report:
+            PrescreenReport(ListImages(args.batch or 'images'), LoadThresholds(args.thresholds))
+            return
+
         # Obtener la configuración desde el archivo .env
         load_dotenv()
         cog_endpoint = os.getenv('AI_SERVICE_ENDPOINT')  # Obtener el punto final del servicio desde las variables de entorno
@@ -25,75 +80,317 @@ def main():
         # Autenticar el cliente Face utilizando las credenciales
         credentials = CognitiveServicesCredentials(cog_key)
         face_client = FaceClient(cog_endpoint, credentials)
+        face_client.config.retry_policy.retries = 0  # Desactivar los reintentos propios de msrest
+        face_client.config.keep_alive = True  # Reutilizar las conexiones entre llamadas
+
+        if args.calibrate:
+            CalibrateThresholds(ListImages(args.batch or 'images'), face_client, args.thresholds)
+            return
+
+        # Modo por lotes: todas las imágenes de la carpeta con un solo cliente compartido
+        if args.batch:
+            DetectFacesBatch(ListImages(args.batch), face_client, args.output, workers=args.workers,
+                             thresholds=thresholds, rejected_dir=args.rejected)
+            return
 
         # Mostrar un menú para seleccionar una función
         print('1: Detect faces\nAny other key to quit')
         command = input('Enter a number:')  # Solicitar al usuario que ingrese un número
         if command == '1':  # Si el usuario ingresa '1', llamar a la función DetectFaces
-            DetectFaces(os.path.join('images','l3xoor.jpg'))  # Pasar la ruta de la imagen como argumento
+            DetectFaces(os.path.join('images','l3xoor.jpg'), thresholds)  # Pasar la ruta de la imagen como argumento
 
     except Exception as ex:  # Capturar y manejar cualquier excepción
         print(ex)  # Imprimir el mensaje de error si ocurre alguna excepción
 
 # Definir la función para detectar caras en una imagen
-def DetectFaces(image_file):
+def DetectFaces(image_file, thresholds=None):
     print('Detecting faces in', image_file)  # Imprimir un mensaje indicando que se están detectando caras en la imagen
 
-    # Especificar las características faciales que se van a recuperar durante la detección
-    features = [FaceAttributeType.occlusion,
-                FaceAttributeType.blur,
-                FaceAttributeType.glasses]
+    # Filtro local: una imagen demasiado pequeña, borrosa o mal expuesta no se envía
+    if thresholds is not None:
+        reason, metrics = Prescreen(image_file, thresholds)
+        if reason:
+            print('Skipped ({}): {}'.format(reason, metrics))
+            return
 
     # Obtener las caras en la imagen utilizando el cliente Face
-    with open(image_file, mode="rb") as image_data:
-        detected_faces = face_client.face.detect_with_stream(image=image_data,
-                                                                return_face_attributes=features,
-                                                                return_face_id=False)
-
-        if len(detected_faces) > 0:  # Si se detectan una o más caras en la imagen
-            print(len(detected_faces), 'faces detected.')  # Imprimir el número de caras detectadas
-
-            # Preparar la imagen para dibujar los cuadros alrededor de las caras
-            fig = plt.figure(figsize=(8, 6))  # Crear una figura con un tamaño específico
-            plt.axis('off')  # Desactivar los ejes de la figura
-            image = Image.open(image_file)  # Abrir la imagen utilizando PIL
-            draw = ImageDraw.Draw(image)  # Crear un objeto ImageDraw para dibujar sobre la imagen
-            color = 'lightgreen'  # Definir el color para los cuadros de las caras
-            face_count = 0  # Inicializar un contador para el número de caras
-
-            # Dibujar y anotar cada cara detectada en la imagen
-            for face in detected_faces:
-                # Obtener las propiedades de la cara detectada
-                face_count += 1  # Incrementar el contador de caras
-                print('\nFace number {}'.format(face_count))  # Imprimir el número de cara
-
-                detected_attributes = face.face_attributes.as_dict()  # Convertir los atributos de la cara a un diccionario
-                if 'blur' in detected_attributes:  # Si se detecta borrosidad en la cara
-                    print(' - Blur:')  # Imprimir un mensaje indicando la detección de borrosidad
-                    for blur_name in detected_attributes['blur']:  # Iterar sobre los diferentes tipos de borrosidad
-                        print('   - {}: {}'.format(blur_name, detected_attributes['blur'][blur_name]))  # Imprimir los detalles de la borrosidad
-
-                if 'occlusion' in detected_attributes:  # Si se detecta ocultamiento en la cara
-                    print(' - Occlusion:')  # Imprimir un mensaje indicando la detección de ocultamiento
-                    for occlusion_name in detected_attributes['occlusion']:  # Iterar sobre los diferentes tipos de ocultamiento
-                        print('   - {}: {}'.format(occlusion_name, detected_attributes['occlusion'][occlusion_name]))  # Imprimir los detalles del ocultamiento
-
-                if 'glasses' in detected_attributes:  # Si se detectan gafas en la cara
-                    print(' - Glasses:{}'.format(detected_attributes['glasses']))  # Imprimir un mensaje indicando la detección de gafas
-
-                # Dibujar un cuadro alrededor de la cara detectada en la imagen
-                r = face.face_rectangle  # Obtener el rectángulo delimitador de la cara
-                bounding_box = ((r.left, r.top), (r.left + r.width, r.top + r.height))  # Definir las coordenadas del cuadro delimitador
-                draw.rectangle(bounding_box, outline=color, width=5)  # Dibujar el cuadro delimitador alrededor de la cara
-                annotation = 'Face number {}'.format(face_count)  # Crear una etiqueta para anotar la cara
-                plt.annotate(annotation,(r.left, r.top), backgroundcolor=color)  # Anotar la cara en la imagen con la etiqueta
-
-            # Guardar la imagen con los cuadros alrededor de las caras detectadas
-            plt.imshow(image)  # Mostrar la imagen con los cuadros de las caras
-            outputfile = 'detected_faces.jpg'  # Definir el nombre del archivo de salida
-            fig.savefig(outputfile)  # Guardar la figura como una imagen
-
-            print('\nResults saved in', outputfile)  # Imprimir un mensaje indicando que los resultados se han guardado en el archivo
+    detected_faces = GetFaces(image_file, face_client)
+    if len(detected_faces) > 0:  # Si se detectan una o más caras en la imagen
+        print(len(detected_faces), 'faces detected.')  # Imprimir el número de caras detectadas
+
+        # Preparar la imagen para dibujar los cuadros alrededor de las caras
+        fig = plt.figure(figsize=(8, 6))  # Crear una figura con un tamaño específico
+        plt.axis('off')  # Desactivar los ejes de la figura
+        image = Image.open(image_file)  # Abrir la imagen utilizando PIL
+        draw = ImageDraw.Draw(image)  # Crear un objeto ImageDraw para dibujar sobre la imagen
+        color = 'lightgreen'  # Definir el color para los cuadros de las caras
+        face_count = 0  # Inicializar un contador para el número de caras
+
+        # Dibujar y anotar cada cara detectada en la imagen
+        for face in detected_faces:
+            # Obtener las propiedades de la cara detectada
+            face_count += 1  # Incrementar el contador de caras
+            print('\nFace number {}'.format(face_count))  # Imprimir el número de cara
+
+            detected_attributes = face.face_attributes.as_dict()  # Convertir los atributos de la cara a un diccionario
+            if 'blur' in detected_attributes:  # Si se detecta borrosidad en la cara
+                print(' - Blur:')  # Imprimir un mensaje indicando la detección de borrosidad
+                for blur_name in detected_attributes['blur']:  # Iterar sobre los diferentes tipos de borrosidad
+                    print('   - {}: {}'.format(blur_name, detected_attributes['blur'][blur_name]))  # Imprimir los detalles de la borrosidad
+
+            if 'occlusion' in detected_attributes:  # Si se detecta ocultamiento en la cara
+                print(' - Occlusion:')  # Imprimir un mensaje indicando la detección de ocultamiento
+                for occlusion_name in detected_attributes['occlusion']:  # Iterar sobre los diferentes tipos de ocultamiento
+                    print('   - {}: {}'.format(occlusion_name, detected_attributes['occlusion'][occlusion_name]))  # Imprimir los detalles del ocultamiento
+
+            if 'glasses' in detected_attributes:  # Si se detectan gafas en la cara
+                print(' - Glasses:{}'.format(detected_attributes['glasses']))  # Imprimir un mensaje indicando la detección de gafas
+
+            # Dibujar un cuadro alrededor de la cara detectada en la imagen
+            r = face.face_rectangle  # Obtener el rectángulo delimitador de la cara
+            bounding_box = ((r.left, r.top), (r.left + r.width, r.top + r.height))  # Definir las coordenadas del cuadro delimitador
+            draw.rectangle(bounding_box, outline=color, width=5)  # Dibujar el cuadro delimitador alrededor de la cara
+            annotation = 'Face number {}'.format(face_count)  # Crear una etiqueta para anotar la cara
+            plt.annotate(annotation,(r.left, r.top), backgroundcolor=color)  # Anotar la cara en la imagen con la etiqueta
+
+        # Guardar la imagen con los cuadros alrededor de las caras detectadas
+        plt.imshow(image)  # Mostrar la imagen con los cuadros de las caras
+        outputfile = 'detected_faces.jpg'  # Definir el nombre del archivo de salida
+        fig.savefig(outputfile)  # Guardar la figura como una imagen
+
+        print('\nResults saved in', outputfile)  # Imprimir un mensaje indicando que los resultados se han guardado en el archivo
+
+# Llama a Face para una imagen; el archivo se vuelve a abrir en cada intento
+# para que un reintento envíe la imagen completa
+def GetFaces(image_file, client):
+    def Detect():
+        with open(image_file, mode="rb") as image_data:
+            return client.face.detect_with_stream(image=image_data,
+                                                  return_face_attributes=FACE_FEATURES,
+                                                  return_face_id=False)
+
+    return limiter.call(Detect)
+
+
+#! Modo por lotes
+# Imágenes de una carpeta (incluidas subcarpetas), en orden
+def ListImages(folder):
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                yield os.path.join(root, name)
+
+
+# Aplana un diccionario anidado: {'blur': {'value': 0.1}} -> {'blur_value': 0.1}
+def Flatten(values, prefix=''):
+    flat = {}
+    for key, value in values.items():
+        if isinstance(value, dict):
+            flat.update(Flatten(value, prefix + key + '_'))
+        else:
+            flat[prefix + key] = value.value if hasattr(value, 'value') else value  # Enums como texto
+    return flat
+
+
+# Filas de la tabla para una imagen: una por cara, o una sola fila con el error
+def FaceRows(image_file, client, thresholds=None):
+    start = time.perf_counter()
+    sharpness = None
+    if thresholds is not None:
+        reason, metrics = Prescreen(image_file, thresholds)
+        sharpness = metrics.get('sharpness')
+        if reason:
+            # Rechazada localmente: fila sin caras y sin llamada al servicio
+            return [{'image': image_file, 'sharpness': sharpness, 'prescreen': reason,
+                     'elapsed_ms': round((time.perf_counter() - start) * 1000, 1)}]
+    try:
+        detected_faces = GetFaces(image_file, client)
+    except Exception as ex:
+        return [{'image': image_file, 'error': str(ex), 'elapsed_ms': round((time.perf_counter() - start) * 1000, 1)}]
+
+    elapsed_ms = round((time.perf_counter() - start) * 1000, 1)
+    rows = []
+    for face_number, face in enumerate(detected_faces, start=1):
+        r = face.face_rectangle
+        row = {'image': image_file, 'face': face_number, 'left': r.left, 'top': r.top,
+               'width': r.width, 'height': r.height, 'sharpness': sharpness, 'elapsed_ms': elapsed_ms}
+        if face.face_attributes is not None:
+            row.update(Flatten(face.face_attributes.as_dict()))
+        rows.append(row)
+    if not rows:
+        rows.append({'image': image_file, 'face': 0, 'sharpness': sharpness, 'elapsed_ms': elapsed_ms})  # Imagen sin caras
+    return rows
+
+
+def DetectFacesBatch(image_files, client, output, workers=8, thresholds=None, rejected_dir=None):
+    # Las imágenes se envían con un número acotado de peticiones en curso y cada
+    # resultado se escribe en el CSV en cuanto llega
+    image_files = iter(image_files)
+    pending = set()
+    images = faces = failed = 0
+    skipped = {}
+    start = time.perf_counter()
+
+    with open(output, 'w', newline='', encoding='utf-8') as out, ThreadPoolExecutor(max_workers=workers) as pool:
+        writer = csv.DictWriter(out, fieldnames=FACE_COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        while True:
+            for image_file in image_files:
+                pending.add(pool.submit(FaceRows, image_file, client, thresholds))
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                rows = future.result()
+                writer.writerows(rows)
+                images += 1
+                failed += 'error' in rows[0]
+                faces += sum(1 for row in rows if row.get('face'))
+                reason = rows[0].get('prescreen')
+                if reason:
+                    skipped[reason] = skipped.get(reason, 0) + 1
+                    if rejected_dir:
+                        RouteRejected(rows[0]['image'], rejected_dir, reason)
+
+    elapsed = time.perf_counter() - start
+    rate = images / elapsed if elapsed > 0 else 0.0
+    print('{} images, {} faces ({} failed) in {:.2f}s ({:.1f} images/sec)'.format(images, faces, failed, elapsed, rate))
+    if thresholds is not None:
+        PrintSkipped(skipped, images)
+    print('  Results saved in', output)
+    return images, elapsed
+
+
+#! Filtro local de calidad
+def RouteRejected(image_file, rejected_dir, reason):
+    # Copia la imagen rechazada a <carpeta>/<motivo>/ para revisarla a mano
+    folder = os.path.join(rejected_dir, reason)
+    os.makedirs(folder, exist_ok=True)
+    shutil.copy2(image_file, os.path.join(folder, os.path.basename(image_file)))
+
+
+def PrintSkipped(skipped, images):
+    saved = sum(skipped.values())
+    share = saved / images if images else 0.0
+    print('  Pre-screen: {} of {} images rejected locally ({} API calls saved, {:.0%})'.format(saved, images, saved, share))
+    for reason, count in sorted(skipped.items()):
+        print('   - {}: {}'.format(reason, count))
+
+
+def PrescreenReport(image_files, thresholds):
+    # Solo el filtro local, sin red: cuántas llamadas se ahorrarían en este corpus
+    images = 0
+    skipped = {}
+    start = time.perf_counter()
+    for image_file in image_files:
+        reason, metrics = Prescreen(image_file, thresholds)
+        images += 1
+        if reason:
+            skipped[reason] = skipped.get(reason, 0) + 1
+        print('{:<40} {:>10} {}'.format(image_file, metrics.get('sharpness', '-'), reason or 'ok'))
+    elapsed = time.perf_counter() - start
+    print('\n{} images screened in {:.2f}s ({:.1f} ms/image)'.format(images, elapsed, elapsed * 1000 / max(images, 1)))
+    PrintSkipped(skipped, images)
+
+
+def CalibrateThresholds(image_files, client, path):
+    # Cada imagen se mide localmente y se envía al servicio; su nivel de blur es el de
+    # la cara más nítida (basta con una cara aprovechable para que la imagen sirva)
+    samples = []
+    for image_file in image_files:
+        reason, metrics = Prescreen(image_file, LoadThresholds(None))
+        if 'sharpness' not in metrics:
+            continue
+        detected_faces = GetFaces(image_file, client)
+        blurs = [face.face_attributes.blur for face in detected_faces
+                 if face.face_attributes is not None and face.face_attributes.blur is not None]
+        if not blurs:
+            print('{:<40} {:>10} no faces'.format(image_file, metrics['sharpness']))
+            continue
+        best = min(blurs, key=lambda blur: blur.value)
+        level = str(getattr(best.blur_level, 'value', best.blur_level)).lower()
+        samples.append((metrics['sharpness'], level))
+        print('{:<40} {:>10} {} ({})'.format(image_file, metrics['sharpness'], level, best.value))
+
+    if not samples:
+        print('No faces found; thresholds not changed')
+        return
+    thresholds, summary, caught = Calibrate(samples, LoadThresholds(path))
+    print('\n Blur     Images     Min  Median     Max')
+    for level, (count, low, median, high) in summary.items():
+        print(' {:<7} {:>7} {:>7.1f} {:>7.1f} {:>7.1f}'.format(level, count, low, median, high))
+    print('\nmin_sharpness = {} (would reject {})'.format(thresholds['min_sharpness'], caught))
+    SaveThresholds(path, thresholds)
+    print('Thresholds saved in', path)
+
+
+#! Benchmark: escalado del modo por lotes contra un servidor Face simulado
+STUB_FACES = [{"faceRectangle": {"top": 40, "left": 50, "width": 120, "height": 120},
+               "faceAttributes": {"blur": {"blurLevel": "low", "value": 0.05},
+                                  "occlusion": {"foreheadOccluded": False, "eyeOccluded": False, "mouthOccluded": False},
+                                  "glasses": "NoGlasses"}}]
+
+
+def StartStubServer(latency=0.1):
+    body = json.dumps(STUB_FACES).encode('utf-8')
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(latency)  # Latencia simulada del servicio
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class StubServer(ThreadingHTTPServer):
+        request_queue_size = 128  # Que las conexiones en paralelo no esperen en la cola del socket
+
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def BenchmarkBatch(folder, concurrency_levels=(1, 2, 4, 8, 16), images=64, latency=0.1):
+    global limiter
+
+    image_files = list(ListImages(folder))
+    if not image_files:
+        print('No images found in', folder)
+        return
+    image_files = (image_files * (images // len(image_files) + 1))[:images]
+
+    server = StartStubServer(latency)
+    client = FaceClient('http://127.0.0.1:{}/'.format(server.server_address[1]), CognitiveServicesCredentials('stub'))
+    client.config.retry_policy.retries = 0
+    client.config.keep_alive = True
+    limiter = RateLimiter(rate=1000)  # Sin cuota en el servidor simulado: solo se mide el paralelismo
+
+    print('Benchmarking {} images against stub server ({:.0f} ms latency)'.format(len(image_files), latency * 1000))
+    rows = []
+    try:
+        for workers in concurrency_levels:
+            processed, elapsed = DetectFacesBatch(image_files, client, os.devnull, workers=workers)
+            rows.append((workers, processed / elapsed))
+    finally:
+        server.shutdown()
+
+    print('\n Workers  Images/sec  Speedup  Efficiency')
+    for workers, rate in rows:
+        speedup = rate / rows[0][1]
+        print(' {:>7}  {:>10.1f}  {:>6.1f}x  {:>9.0%}'.format(workers, rate, speedup, speedup / workers))
+
 
 # Comprobar si este script es el script principal
 if __name__ == "__main__":
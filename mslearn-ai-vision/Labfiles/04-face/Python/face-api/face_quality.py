@@ -0,0 +1,132 @@
+# Filtro local de calidad previo a la detección de caras.
+#
+# Antes de pagar una llamada a Face se mide la imagen con NumPy: tamaño mínimo,
+# nitidez (varianza del laplaciano) y exposición (histograma de grises). Las
+# imágenes que no pasan se descartan sin tocar la red. El umbral de nitidez se
+# puede calibrar con los niveles de blur (low/medium/high) que devuelve el
+# servicio para una muestra de imágenes.
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+# Lado al que se reduce la imagen antes de medir; así la nitidez no depende de la resolución
+ANALYSIS_SIDE = 512
+# Rejilla de teselas para la nitidez: una cara enfocada sobre un fondo desenfocado
+# sigue dando teselas nítidas aunque la media de la imagen sea baja
+TILES = 8
+SHARP_PERCENTILE = 90
+
+# Umbrales por defecto (se sustituyen por los calibrados si existe el archivo)
+DEFAULT_THRESHOLDS = {
+    'min_side': 36,             # Lado mínimo en píxeles: Face no detecta caras de menos de 36x36
+    'max_bytes': 6 * 1024 * 1024,  # Tamaño máximo de archivo que acepta Face
+    'min_sharpness': 15.0,      # Varianza del laplaciano en el percentil SHARP_PERCENTILE de las teselas
+    'max_dark': 0.75,           # Fracción máxima de píxeles casi negros
+    'max_bright': 0.75,         # Fracción máxima de píxeles casi blancos
+    'min_contrast': 24,         # Rango mínimo entre los percentiles 1 y 99 del histograma
+}
+
+BLUR_LEVELS = ('low', 'medium', 'high')
+
+
+def LoadThresholds(path):
+    thresholds = dict(DEFAULT_THRESHOLDS)
+    if path and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            thresholds.update(json.load(f))
+    return thresholds
+
+
+def SaveThresholds(path, thresholds):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(thresholds, f, indent=2)
+
+
+#! Medidas
+def Sharpness(gray):
+    # Varianza del laplaciano (núcleo de 4 vecinos) por teselas
+    lap = (gray[:-2, 1:-1] + gray[2:, 1:-1] + gray[1:-1, :-2] + gray[1:-1, 2:]
+           - 4 * gray[1:-1, 1:-1])
+    h, w = lap.shape
+    th, tw = h // TILES, w // TILES
+    if th < 3 or tw < 3:
+        return float(lap.var())
+    tiles = lap[:th * TILES, :tw * TILES].reshape(TILES, th, TILES, tw)
+    return float(np.percentile(tiles.var(axis=(1, 3)), SHARP_PERCENTILE))
+
+
+def Exposure(gray):
+    # Fracciones de sombras y luces quemadas y rango de contraste a partir del histograma
+    hist = np.bincount(gray.astype(np.uint8).ravel(), minlength=256)
+    cdf = np.cumsum(hist) / hist.sum()
+    low, high = np.searchsorted(cdf, [0.01, 0.99])
+    return float(cdf[15]), float(1 - cdf[239]), int(high - low)
+
+
+def Measure(image_file):
+    metrics = {'bytes': os.path.getsize(image_file)}
+    with Image.open(image_file) as image:
+        metrics['width'], metrics['height'] = image.size
+        image.draft('L', (ANALYSIS_SIDE, ANALYSIS_SIDE))  # JPEG: decodificar ya reducida
+        gray = image.convert('L')
+        gray.thumbnail((ANALYSIS_SIDE, ANALYSIS_SIDE))
+    gray = np.asarray(gray, dtype=np.float32)
+    metrics['sharpness'] = round(Sharpness(gray), 2)
+    metrics['dark'], metrics['bright'], metrics['contrast'] = Exposure(gray)
+    return metrics
+
+
+def Check(metrics, thresholds):
+    # Motivo del rechazo, o None si la imagen debe enviarse al servicio
+    if min(metrics['width'], metrics['height']) < thresholds['min_side']:
+        return 'too_small'
+    if metrics['bytes'] > thresholds['max_bytes']:
+        return 'too_large'
+    if metrics['dark'] > thresholds['max_dark']:
+        return 'underexposed'
+    if metrics['bright'] > thresholds['max_bright']:
+        return 'overexposed'
+    if metrics['contrast'] < thresholds['min_contrast']:
+        return 'low_contrast'
+    if metrics['sharpness'] < thresholds['min_sharpness']:
+        return 'blurry'
+    return None
+
+
+def Prescreen(image_file, thresholds):
+    # (motivo, medidas); una imagen que no se puede decodificar también se rechaza
+    try:
+        metrics = Measure(image_file)
+    except (OSError, ValueError) as ex:
+        return 'unreadable', {'error': str(ex)}
+    return Check(metrics, thresholds), metrics
+
+
+#! Calibración con los niveles de blur del servicio
+def Calibrate(samples, thresholds=None, margin=0.8):
+    # samples: [(nitidez local, nivel de blur del servicio)]. Solo se quiere evitar el
+    # nivel 'high': el umbral es el más alto que no descarta ninguna imagen 'low' o
+    # 'medium', con un margen. Sin muestras 'high' el umbral solo puede bajar.
+    thresholds = dict(thresholds or DEFAULT_THRESHOLDS)
+    sharpness = np.array([s for s, level in samples], dtype=np.float64)
+    levels = np.array([level.lower() for s, level in samples])
+
+    summary = {}
+    for level in BLUR_LEVELS:
+        values = sharpness[levels == level]
+        if len(values):
+            summary[level] = (len(values), float(values.min()), float(np.median(values)), float(values.max()))
+
+    keep = sharpness[levels != 'high']
+    if len(keep):
+        limit = round(float(keep.min()) * margin, 2)
+        if 'high' in summary:
+            thresholds['min_sharpness'] = limit
+        else:
+            thresholds['min_sharpness'] = min(thresholds['min_sharpness'], limit)
+
+    rejected = sharpness < thresholds['min_sharpness']
+    caught = {level: int((rejected & (levels == level)).sum()) for level in BLUR_LEVELS}
+    return thresholds, summary, caught
@@ -0,0 +1,169 @@
+# Representación columnar de los resultados de OCR.
+#
+# En lugar de tuplas de tuplas por palabra, todas las palabras de un documento se
+# guardan en arreglos planos de NumPy: polígonos de 4 puntos en float32, confianzas
+# en float32, la línea a la que pertenece cada palabra y el texto concatenado en un
+# único bloque UTF-8 con sus desplazamientos. Así las consultas ("palabras con
+# confianza < 0.8 dentro de la región R") son operaciones vectorizadas y el
+# resultado se guarda en un .npz compacto.
+import numpy as np
+
+
+def _pack_text(texts):
+    # Texto -> (bloque de bytes UTF-8, desplazamientos de inicio/fin)
+    encoded = [text.encode('utf-8') for text in texts]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(item) for item in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def _unpack_text(chars, offsets, index):
+    return chars[offsets[index]:offsets[index + 1]].tobytes().decode('utf-8')
+
+
+class OcrTable:
+
+    def __init__(self, word_chars, word_offsets, word_line, word_polygons, word_confidence,
+                 line_chars, line_offsets, line_page, line_polygons):
+        self.word_chars = word_chars
+        self.word_offsets = word_offsets
+        self.word_line = word_line                # int32 (n_words,): índice de la línea de cada palabra
+        self.word_polygons = word_polygons        # float32 (n_words, 4, 2)
+        self.word_confidence = word_confidence    # float32 (n_words,)
+        self.line_chars = line_chars
+        self.line_offsets = line_offsets
+        self.line_page = line_page                # int32 (n_lines,): página de cada línea
+        self.line_polygons = line_polygons        # float32 (n_lines, 4, 2)
+
+    def __len__(self):
+        return len(self.word_confidence)
+
+    @property
+    def word_page(self):
+        return self.line_page[self.word_line]
+
+    @property
+    def line_count(self):
+        return len(self.line_page)
+
+    #! Construcción
+    @classmethod
+    def from_lines(cls, lines, page=1):
+        # lines: iterable de (texto, polígono, [(texto, polígono, confianza), ...])
+        line_text, line_polygons, word_text, word_polygons, word_confidence, word_line = [], [], [], [], [], []
+        for line_index, (text, polygon, words) in enumerate(lines):
+            line_text.append(text)
+            line_polygons.append(polygon)
+            for word in words:
+                word_text.append(word[0])
+                word_polygons.append(word[1])
+                word_confidence.append(word[2])
+                word_line.append(line_index)
+
+        word_chars, word_offsets = _pack_text(word_text)
+        line_chars, line_offsets = _pack_text(line_text)
+        return cls(word_chars, word_offsets,
+                   np.array(word_line, dtype=np.int32),
+                   np.array(word_polygons, dtype=np.float32).reshape(-1, 4, 2),
+                   np.array(word_confidence, dtype=np.float32),
+                   line_chars, line_offsets,
+                   np.full(len(line_text), page, dtype=np.int32),
+                   np.array(line_polygons, dtype=np.float32).reshape(-1, 4, 2))
+
+    @classmethod
+    def from_result(cls, result, page=1):
+        # Todas las líneas de todos los bloques de un resultado de VisualFeatures.READ
+        def Polygon(points):
+            return [(point.x, point.y) for point in points]
+
+        lines = []
+        if result.read is not None:
+            for block in result.read.blocks:
+                for line in block.lines:
+                    words = [(word.text, Polygon(word.bounding_polygon), word.confidence) for word in line.words]
+                    lines.append((line.text, Polygon(line.bounding_polygon), words))
+        return cls.from_lines(lines, page)
+
+    @classmethod
+    def from_record(cls, record):
+        # Registro de página escrito por ReadDocument (una línea de pages.jsonl)
+        lines = [(line['text'], line['polygon'],
+                  [(word['text'], word['polygon'], word['confidence']) for word in line['words']])
+                 for line in record['lines']]
+        return cls.from_lines(lines, record['page'])
+
+    @classmethod
+    def concat(cls, tables):
+        tables = list(tables)
+        if not tables:
+            return cls.from_lines([])
+        line_base = np.cumsum([0] + [table.line_count for table in tables[:-1]])
+
+        def Offsets(offsets_list):
+            # Desplaza los desplazamientos de cada tabla al final del bloque anterior
+            base, parts = 0, [np.zeros(1, dtype=np.int64)]
+            for offsets in offsets_list:
+                parts.append(offsets[1:] + base)
+                base += offsets[-1]
+            return np.concatenate(parts)
+
+        return cls(np.concatenate([t.word_chars for t in tables]),
+                   Offsets([t.word_offsets for t in tables]),
+                   np.concatenate([t.word_line + base for t, base in zip(tables, line_base)]).astype(np.int32),
+                   np.concatenate([t.word_polygons for t in tables]),
+                   np.concatenate([t.word_confidence for t in tables]),
+                   np.concatenate([t.line_chars for t in tables]),
+                   Offsets([t.line_offsets for t in tables]),
+                   np.concatenate([t.line_page for t in tables]),
+                   np.concatenate([t.line_polygons for t in tables]))
+
+    #! Persistencia
+    FIELDS = ('word_chars', 'word_offsets', 'word_line', 'word_polygons', 'word_confidence',
+              'line_chars', 'line_offsets', 'line_page', 'line_polygons')
+
+    def save(self, path):
+        np.savez_compressed(path, **{field: getattr(self, field) for field in self.FIELDS})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(*(data[field] for field in cls.FIELDS))
+
+    #! Consultas vectorizadas
+    def word(self, index):
+        return _unpack_text(self.word_chars, self.word_offsets, index)
+
+    def line(self, index):
+        return _unpack_text(self.line_chars, self.line_offsets, index)
+
+    def words(self, indices):
+        return [self.word(index) for index in indices]
+
+    def query(self, max_confidence=None, region=None, page=None, overlap=False):
+        # Índices de las palabras que cumplen todos los filtros.
+        # region = (x0, y0, x1, y1); por defecto la palabra debe quedar dentro de la región,
+        # con overlap=True basta con que la toque.
+        mask = np.ones(len(self), dtype=bool)
+        if max_confidence is not None:
+            mask &= self.word_confidence < max_confidence
+        if page is not None:
+            mask &= self.word_page == page
+        if region is not None:
+            x0, y0, x1, y1 = region
+            mins = self.word_polygons.min(axis=1)
+            maxs = self.word_polygons.max(axis=1)
+            if overlap:
+                mask &= (maxs[:, 0] >= x0) & (mins[:, 0] <= x1) & (maxs[:, 1] >= y0) & (mins[:, 1] <= y1)
+            else:
+                mask &= (mins[:, 0] >= x0) & (maxs[:, 0] <= x1) & (mins[:, 1] >= y0) & (maxs[:, 1] <= y1)
+        return np.flatnonzero(mask)
+
+    def line_words(self, line_index):
+        return np.flatnonzero(self.word_line == line_index)
+
+    def lines_without_words(self, page=None):
+        # Índices de las líneas que no tienen palabras
+        mask = np.bincount(self.word_line, minlength=self.line_count) == 0
+        if page is not None:
+            mask &= self.line_page == page
+        return np.flatnonzero(mask)
@@ -1,7 +1,14 @@
 from dotenv import load_dotenv  # Importa la función `load_dotenv` de la librería `dotenv`
 import os  # Importa el módulo `os` para acceder a variables de entorno y otras funcionalidades del sistema operativo
 import time  # Importa el módulo `time` para trabajar con el tiempo
-from PIL import Image, ImageDraw  # Importa clases de la librería `PIL` para trabajar con imágenes
+import io  # Importa el módulo `io` para codificar páginas en memoria
+import sys  # Importa el módulo `sys` para leer argumentos de la línea de comandos
+import json  # Importa el módulo `json` para escribir resultados en formato JSON Lines
+import argparse  # Importa el módulo `argparse` para interpretar argumentos
+import numpy as np  # Importa NumPy para trabajar con los resultados en forma columnar
+from collections import deque  # Cola para mantener el orden de las páginas en curso
+from concurrent.futures import ThreadPoolExecutor  # Pool de hilos para enviar páginas en paralelo
+from PIL import Image, ImageDraw, ImageSequence  # Importa clases de la librería `PIL` para trabajar con imágenes
 from matplotlib import pyplot as plt  # Importa la función `pyplot` de la librería `matplotlib` para visualización de datos
 
 # Importa clases y funciones específicas de la librería Azure AI Vision
@@ -9,11 +16,37 @@ from azure.ai.vision.imageanalysis import ImageAnalysisClient
 from azure.ai.vision.imageanalysis.models import VisualFeatures
 from azure.core.credentials import AzureKeyCredential
 
+from ocr_table import OcrTable  # Almacenamiento columnar de palabras, polígonos y confianzas
+from rate_limiter import RateLimiter  # Limitador de peticiones compartido con reintentos ante respuestas 429
+
+# Todas las llamadas al servicio pasan por el limitador (los reintentos los maneja él, no azure-core)
+limiter = RateLimiter(rate=10)
+
 def main():  # Define la función principal `main`
 
     global cv_client  # Define una variable global `cv_client`
 
+    # Argumentos antes de crear el cliente, para que --help funcione sin archivo .env
+    parser = argparse.ArgumentParser(description='OCR de documentos de varias páginas (PDF, TIFF o imágenes)')
+    parser.add_argument('document', nargs='?', help='Documento o imagen a leer (sin argumentos se muestra el menú)')
+    parser.add_argument('--serve', metavar='QUEUE',
+                        help="Modo servicio: carpeta de cola a vigilar o '-' para leer rutas de la entrada estándar")
+    parser.add_argument('--output', default='pages.jsonl', help='Archivo JSON Lines de salida')
+    parser.add_argument('--workers', type=int, default=4, help='Páginas enviadas en paralelo')
+    parser.add_argument('--dpi', type=int, default=200, help='Resolución para rasterizar páginas de PDF')
+    parser.add_argument('--npz', help='Guardar también todas las palabras en forma columnar (.npz)')
+    parser.add_argument('--benchmark-render', action='store_true',
+                        help='Comparar la velocidad de dibujo (no necesita el servicio)')
+    args = parser.parse_args()
+    if len(sys.argv) > 1 and not (args.document or args.serve or args.benchmark_render):
+        parser.error('falta el documento a leer (o --serve)')
+
     try:  # Manejo de excepciones para capturar errores
+        # Comparación de velocidad de dibujo (no necesita el servicio)
+        if args.benchmark_render:
+            BenchmarkRender()
+            return
+
         # Obtener configuración desde archivos de entorno
         load_dotenv()  # Carga las variables de entorno desde un archivo `.env`
         ai_endpoint = os.getenv('AI_SERVICE_ENDPOINT')  # Obtiene la URL del servicio de AI desde las variables de entorno
@@ -22,11 +55,20 @@ def main():  # Define la función principal `main`
         # Autentica el cliente de Azure AI Vision
         cv_client = ImageAnalysisClient(
             endpoint=ai_endpoint,
-            credential=AzureKeyCredential(ai_key)
+            credential=AzureKeyCredential(ai_key),
+            retry_total=0
         )
 
+        # Documento pasado por línea de comandos: OCR de todas sus páginas a JSON Lines
+        if args.serve:
+            Serve(args.serve, args.output, workers=args.workers, dpi=args.dpi)
+            return
+        if args.document:
+            ReadDocument(args.document, args.output, workers=args.workers, dpi=args.dpi, npz=args.npz)
+            return
+
         # Menú para funciones de lectura de texto
-        print('\n1: Use Read API for image (Lincoln.jpg)\n2: Read handwriting (Note.jpg)\nAny other key to quit\n')
+        print('\n1: Use Read API for image (Lincoln.jpg)\n2: Read handwriting (Note.jpg)\n3: Read document to JSON Lines (Rome.pdf)\nAny other key to quit\n')
         command = input('Enter a number:')  # Solicita al usuario ingresar un número
         if command == '1':  # Si el usuario ingresa '1'
             image_file = os.path.join('images','Lincoln.jpg')  # Define la ruta de la imagen a procesar
@@ -34,6 +76,9 @@ def main():  # Define la función principal `main`
         elif command =='2':  # Si el usuario ingresa '2'
             image_file = os.path.join('images','Note.jpg')  # Define la ruta de la imagen a procesar
             GetTextRead(image_file)  # Llama a la función `GetTextRead` para procesar la imagen
+        elif command =='3':  # Si el usuario ingresa '3'
+            document = os.path.join('images','Rome.pdf')  # Documento de varias páginas
+            ReadDocument(document, 'pages.jsonl')  # Lee todas las páginas y guarda el resultado en JSON Lines
                 
 
     except Exception as ex:  # Captura cualquier excepción y la almacena en `ex`
@@ -47,7 +92,8 @@ def GetTextRead(image_file):  # Define la función `GetTextRead` que toma la rut
             image_data = f.read()
 
     # Utiliza la función `analyze` para leer el texto en la imagen
-    result = cv_client.analyze(
+    result = limiter.call(
+        cv_client.analyze,
         image_data=image_data,
         visual_features=[VisualFeatures.READ]
     )
@@ -56,48 +102,301 @@ def GetTextRead(image_file):  # Define la función `GetTextRead` que toma la rut
     if result.read is not None:  # Si se detectó texto en la imagen
         print("\nText:")  # Imprime un encabezado
 
-        # Abre la imagen
-        image = Image.open(image_file)
-        fig = plt.figure(figsize=(image.width/100, image.height/100))
-        plt.axis('off')
-        draw = ImageDraw.Draw(image)
-        color = 'cyan'
+        # Resultado en forma columnar: todas las líneas y palabras de todos los bloques
+        table = OcrTable.from_result(result)
+        word_bounds = np.searchsorted(table.word_line, np.arange(table.line_count + 1))  # Palabras de cada línea
 
-        # Recorre las líneas de texto detectadas en la imagen
-        for line in result.read.blocks[0].lines:
-            print(f"  {line.text}")  # Imprime el texto de cada línea
+        for line_index in range(table.line_count):
+            print(f"  {table.line(line_index)}")  # Imprime el texto de cada línea
+            print("   Bounding Polygon: {}".format(table.line_polygons[line_index].tolist()))
 
-            drawLinePolygon = True
+            word_indices = range(word_bounds[line_index], word_bounds[line_index + 1])
+            for word_index in word_indices:
+                print(f"    Word: '{table.word(word_index)}', Bounding Polygon: {table.word_polygons[word_index].tolist()}, "
+                      f"Confidence: {table.word_confidence[word_index]:.4f}")
 
-            r = line.bounding_polygon
-            bounding_polygon = ((r[0].x, r[0].y),(r[1].x, r[1].y),(r[2].x, r[2].y),(r[3].x, r[3].y))
+        print("\n")
 
-            print("   Bounding Polygon: {}".format(bounding_polygon))
+        for line_index in range(table.line_count):
+            print(f"  {table.line(line_index)}") 
 
-            for word in line.words:
-                r = word.bounding_polygon
-                bounding_polygon = ((r[0].x, r[0].y),(r[1].x, r[1].y),(r[2].x, r[2].y),(r[3].x, r[3].y))
-                print(f"    Word: '{word.text}', Bounding Polygon: {bounding_polygon}, Confidence: {word.confidence:.4f}")
+        
 
-                drawLinePolygon = False
-                draw.polygon(bounding_polygon, outline=color, width=3)
+        # Dibuja todas las líneas y palabras de una vez y guarda la imagen
+        outputfile = 'text.jpg'
+        SaveTextOverlay(image_file, table, outputfile)
+        print('\n  Results saved in', outputfile)
 
-            if drawLinePolygon:
-                draw.polygon(bounding_polygon, outline=color, width=3)
+        table.save('text.npz')  # Palabras, polígonos y confianzas en arreglos planos
+        print('  Words saved in text.npz')
 
-        print("\n")
+# Colores por confianza de palabra: rojo (baja) -> amarillo -> verde (alta)
+CONFIDENCE_STOPS = [0.5, 0.75, 1.0]
+CONFIDENCE_RGB = np.array([[255, 0, 0], [255, 220, 0], [0, 200, 0]], dtype=np.float32)
+LINE_RGB = (0, 255, 255)  # Cian para los polígonos de línea
 
-        for line in result.read.blocks[0].lines:
-            print(f"  {line.text}") 
 
-        
+def ConfidenceColors(confidence):
+    return np.stack([np.interp(confidence, CONFIDENCE_STOPS, CONFIDENCE_RGB[:, channel])
+                     for channel in range(3)], axis=1).astype(np.uint8)
+
+
+# Dibuja los contornos de todos los polígonos de una vez sobre un arreglo de píxeles (alto, ancho, 3)
+def DrawPolygons(pixels, polygons, colors, width=3):
+    if len(polygons) == 0:
+        return
+    height, image_width = pixels.shape[:2]
+
+    # Cada polígono tiene 4 lados: se muestrean todos los lados a 1 píxel de distancia
+    starts = polygons.reshape(-1, 2)
+    ends = np.roll(polygons, -1, axis=1).reshape(-1, 2)
+    lengths = np.ceil(np.abs(ends - starts).max(axis=1)).astype(np.int64) + 1
+    segment = np.repeat(np.arange(len(starts)), lengths)
+    first = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    t = (np.arange(len(segment)) - first) / np.maximum(lengths - 1, 1)[segment]
+    points = starts[segment] + t[:, None] * (ends - starts)[segment]
+    xs = np.rint(points[:, 0]).astype(np.int32)
+    ys = np.rint(points[:, 1]).astype(np.int32)
+    point_colors = colors[segment // 4]
+
+    # El grosor se consigue desplazando todos los puntos con un pincel cuadrado
+    low = -(width // 2)
+    for dy in range(low, low + width):
+        for dx in range(low, low + width):
+            x, y = xs + dx, ys + dy
+            valid = (x >= 0) & (x < image_width) & (y >= 0) & (y < height)
+            pixels[y[valid], x[valid]] = point_colors[valid]
+
+
+def RenderOverlay(image, table, page=None, width=3):
+    pixels = np.array(image.convert('RGB'))  # Se decodifica la imagen una sola vez
+    lines = np.arange(table.line_count) if page is None else np.flatnonzero(table.line_page == page)
+    words = np.arange(len(table)) if page is None else np.flatnonzero(table.word_page == page)
+
+    DrawPolygons(pixels, table.line_polygons[lines], np.tile(np.array(LINE_RGB, dtype=np.uint8), (len(lines), 1)), width)
+    DrawPolygons(pixels, table.word_polygons[words], ConfidenceColors(table.word_confidence[words]), width)
+    return Image.fromarray(pixels)
+
+
+def SaveTextOverlay(image_file, table, outputfile, page=None):
+    # El formato sale de la extensión (.jpg, .webp, .png), sin pasar por matplotlib
+    with Image.open(image_file) as image:
+        overlay = RenderOverlay(image, table, page)
+    overlay.save(outputfile, quality=90)
+
+
+# Compara el dibujo con matplotlib (polígono a polígono) con el dibujo vectorizado
+def BenchmarkRender(scale=4, words_per_image=6000, repeats=3):
+    rng = np.random.default_rng(0)
+    for name in ('Lincoln.jpg', 'Note.jpg'):
+        with Image.open(os.path.join('images', name)) as original:
+            image = original.convert('RGB').resize((original.width * scale, original.height * scale))
+
+        # Rejilla de palabras sintéticas algo inclinadas que cubre la imagen
+        columns = 60
+        rows = int(np.ceil(words_per_image / columns))
+        cell_w, cell_h = image.width / columns, image.height / rows
+        grid_x, grid_y = np.meshgrid(np.arange(columns) * cell_w, np.arange(rows) * cell_h)
+        origin = np.stack([grid_x.ravel(), grid_y.ravel()], axis=1)[:words_per_image]
+        box = np.array([[0, 0], [cell_w * 0.8, 0], [cell_w * 0.8, cell_h * 0.7], [0, cell_h * 0.7]])
+        polygons = (origin[:, None, :] + box[None] + rng.normal(0, 1.5, (len(origin), 4, 2))).astype(np.float32)
+        lines = [("line", polygons[i].tolist(), [("word", polygons[i].tolist(), float(c))])
+                 for i, c in enumerate(rng.uniform(0.3, 1.0, len(polygons)))]
+        table = OcrTable.from_lines(lines)
+
+        def Matplotlib():
+            canvas = image.copy()
+            fig = plt.figure(figsize=(canvas.width/100, canvas.height/100))
+            plt.axis('off')
+            draw = ImageDraw.Draw(canvas)
+            for polygon in table.word_polygons:
+                draw.polygon(polygon.ravel().tolist(), outline='cyan', width=3)
+            plt.imshow(canvas)
+            plt.tight_layout(pad=0)
+            fig.savefig('benchmark_matplotlib.jpg')
+            plt.close(fig)
+
+        def Vectorized():
+            RenderOverlay(image, table).save('benchmark_vectorized.jpg', quality=90)
+
+        print('{} at {}x{} with {} words:'.format(name, image.width, image.height, len(table)))
+        for label, render in (('matplotlib', Matplotlib), ('vectorized', Vectorized)):
+            start = time.perf_counter()
+            for _ in range(repeats):
+                render()
+            print('  {:<11} {:>8.0f} ms'.format(label, (time.perf_counter() - start) / repeats * 1000))
+
+
+# Recorre las páginas de un documento de forma perezosa: solo se rasteriza una página cuando se necesita
+def IterPages(document, dpi=200):
+    if document.lower().endswith('.pdf'):
+        import pypdfium2 as pdfium  # Solo se necesita para documentos PDF
+
+        pdf = pdfium.PdfDocument(document)
+        try:
+            for index in range(len(pdf)):
+                page = pdf[index]
+                image = page.render(scale=dpi / 72).to_pil()  # Rasteriza la página a la resolución pedida
+                page.close()
+                yield index + 1, EncodePage(image)
+        finally:
+            pdf.close()
+    else:
+        # TIFF de varias páginas (o una imagen normal, que tiene una sola)
+        with Image.open(document) as image:
+            for index, frame in enumerate(ImageSequence.Iterator(image)):
+                yield index + 1, EncodePage(frame)
+
+
+def EncodePage(image):
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, 'JPEG', quality=90)  # JPEG mantiene cada página muy por debajo del límite de tamaño del servicio
+    return buffer.getvalue()
+
+
+# Convierte el resultado de una página en un registro con todas las líneas de todos los bloques
+def PageRecord(page_number, result):
+    def Polygon(points):
+        return [[point.x, point.y] for point in points]
+
+    lines = []
+    if result.read is not None:
+        for block in result.read.blocks:
+            for line in block.lines:
+                lines.append({
+                    "text": line.text,
+                    "polygon": Polygon(line.bounding_polygon),
+                    "words": [{"text": word.text, "polygon": Polygon(word.bounding_polygon),
+                               "confidence": word.confidence} for word in line.words]
+                })
+    return {"page": page_number, "width": result.metadata.width, "height": result.metadata.height, "lines": lines}
+
+
+def ReadPage(page_number, page_data):
+    result = limiter.call(cv_client.analyze, image_data=page_data, visual_features=[VisualFeatures.READ])
+    return PageRecord(page_number, result)
+
+
+# Envía las páginas de un documento en paralelo y devuelve sus registros en orden de página
+def ReadPages(document, pool, max_in_flight, dpi=200):
+    pending = deque()  # Páginas en curso, en orden de página
+    for page_number, page_data in IterPages(document, dpi):
+        pending.append(pool.submit(ReadPage, page_number, page_data))
+        if len(pending) >= max_in_flight:  # Como mucho estas páginas rasterizadas a la vez en memoria
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+# Lee un documento de varias páginas enviando páginas en paralelo y escribiendo una línea JSON por página
+def ReadDocument(document, output, workers=4, dpi=200, npz=None):
+    print('Reading text in {}\n'.format(document))
+    pages = words = 0
+    tables = []  # Tablas columnares por página (solo si se pidió un .npz)
+    start = time.perf_counter()
+
+    with open(output, 'w', encoding='utf-8') as out, ThreadPoolExecutor(max_workers=workers) as pool:
+        for record in ReadPages(document, pool, workers * 2, dpi):
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+            out.flush()
+            print('  Page {}: {} lines'.format(record['page'], len(record['lines'])))
+            if npz:
+                tables.append(OcrTable.from_record(record))
+            pages += 1
+            words += sum(len(line['words']) for line in record['lines'])
+
+    elapsed = time.perf_counter() - start
+    print('\n{} pages, {} words in {:.1f}s'.format(pages, words, elapsed))
+    print('  Results saved in', output)
+    if npz:
+        OcrTable.concat(tables).save(npz)
+        print('  Words saved in', npz)
+
+
+#! Modo servicio: un proceso de larga duración con el cliente ya creado
+DOCUMENT_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff', '.webp', '.pdf')
+
+
+# Rutas de documentos desde la entrada estándar, una por línea, hasta fin de archivo
+def StdinDocuments():
+    for line in sys.stdin:
+        path = line.strip()
+        if path:
+            yield path, None
+
+
+# Documentos nuevos en una carpeta de cola; cada uno se mueve a done/ o failed/ al terminar.
+# Un documento solo se lee cuando su tamaño y fecha no han cambiado entre dos consultas,
+# para no rasterizar un PDF que aún se está copiando. Los nombres temporales (.part,
+# .tmp, ocultos o que empiezan por ~) se ignoran, así que copiar con otro nombre y
+# renombrar al final también funciona.
+def QueueDocuments(folder, poll_interval=1.0):
+    os.makedirs(os.path.join(folder, 'done'), exist_ok=True)
+    os.makedirs(os.path.join(folder, 'failed'), exist_ok=True)
+    previous = {}  # nombre -> (tamaño, fecha) en la consulta anterior
+    while True:
+        current = {}
+        for name in sorted(os.listdir(folder)):
+            path = os.path.join(folder, name)
+            if name.startswith(('.', '~')) or not name.lower().endswith(DOCUMENT_EXTENSIONS):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # Movido o borrado mientras se listaba
+            if os.path.isfile(path):
+                current[name] = (stat.st_size, stat.st_mtime_ns)
+
+        ready = [name for name, stat in current.items() if previous.get(name) == stat]
+        previous = {name: stat for name, stat in current.items() if name not in ready}
+        for name in ready:
+            yield os.path.join(folder, name), folder
+        if not ready:
+            time.sleep(poll_interval)  # Nada estable todavía: esperar a la siguiente consulta
+
+
+def LatencySummary(latencies):
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    return 'docs={} p50={:.0f}ms p90={:.0f}ms p99={:.0f}ms max={:.0f}ms'.format(
+        len(latencies), p50, p90, p99, max(latencies))
+
+
+def Serve(queue, output, workers=4, dpi=200, report_every=20):
+    print('OCR worker ready, reading documents from {}'.format('stdin' if queue == '-' else queue))
+    documents = StdinDocuments() if queue == '-' else QueueDocuments(queue)
+    latencies = []  # Latencia de extremo a extremo de cada documento (ms)
+
+    with open(output, 'a', encoding='utf-8') as out, ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            for document, queue_folder in documents:
+                start = time.perf_counter()
+                status = 'done'
+                try:
+                    for record in ReadPages(document, pool, workers * 2, dpi):
+                        record['document'] = document
+                        out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    out.flush()  # Cada documento queda escrito en cuanto termina
+                except Exception as ex:
+                    status = 'failed'
+                    out.write(json.dumps({'document': document, 'error': str(ex)}, ensure_ascii=False) + '\n')
+                    out.flush()
+
+                latency = (time.perf_counter() - start) * 1000
+                latencies.append(latency)
+                print('  {} {} ({:.0f} ms)'.format(status, document, latency))
+                if queue_folder is not None:
+                    os.replace(document, os.path.join(queue_folder, status, os.path.basename(document)))
+                if len(latencies) % report_every == 0:
+                    print('  Latency: {}'.format(LatencySummary(latencies)))
+        except KeyboardInterrupt:
+            print('\nStopping OCR worker...')
+
+    if latencies:
+        print('\nLatency: {}'.format(LatencySummary(latencies)))
+    print('  Results saved in', output)
 
-        # Guarda la imagen
-        plt.imshow(image)
-        plt.tight_layout(pad=0)
-        outputfile = 'text.jpg'
-        fig.savefig(outputfile)
-        print('\n  Results saved in', outputfile)
 
 if __name__ == "__main__":  # Verifica si este script es el punto de entrada principal
     main()  # Llama a la función principal `main` para comenzar la ejecución del programa
@@ -1,10 +1,40 @@
 from azure.cognitiveservices.vision.customvision.prediction import CustomVisionPredictionClient
 from msrest.authentication import ApiKeyCredentials
+import argparse
+import csv
+import hashlib
+import json
+import threading
+import time
 import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
+
+# Shared limiter with retries on 429 for every prediction call
+from rate_limiter import RateLimiter
+
+limiter = RateLimiter(rate=10)
+
+CACHE_FILE = 'prediction-cache.jsonl'
+# Predicted tag when no probability reaches the threshold
+NO_TAG = '(none)'
+# Images tried to learn the published iteration before giving up
+PROBE_ATTEMPTS = 3
+# Upper bounds (ms) of the latency histogram buckets
+LATENCY_BUCKETS = (50, 100, 200, 400, 800, 1600, 3200)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.gif')
 
 def main():
     from dotenv import load_dotenv
 
+    parser = argparse.ArgumentParser(description='Classify images with a published Custom Vision model')
+    parser.add_argument('--evaluate', help='Folder with one subfolder of labeled images per tag')
+    parser.add_argument('--workers', type=int, default=8, help='Prediction calls in parallel')
+    parser.add_argument('--threshold', type=float, default=0.5, help='Minimum probability for a prediction to count')
+    parser.add_argument('--cache', default=CACHE_FILE, help='Cache of predictions per iteration and image')
+    parser.add_argument('--output', default='evaluation.csv', help='CSV with one row per evaluated image')
+    args = parser.parse_args()
+
     try:
         # Get Configuration Settings
         load_dotenv()
@@ -16,19 +46,248 @@ def main():
         # Authenticate a client for the training API
         credentials = ApiKeyCredentials(in_headers={"Prediction-key": prediction_key})
         prediction_client = CustomVisionPredictionClient(endpoint=prediction_endpoint, credentials=credentials)
+        prediction_client.config.retry_policy.retries = 0  # Retries are handled by the limiter
+        prediction_client.config.keep_alive = True
+
+        # Evaluate the model against labeled images
+        if args.evaluate:
+            Evaluate_Model(prediction_client, project_id, model_name, args.evaluate, args.cache, args.output,
+                           workers=args.workers, threshold=args.threshold)
+            return
 
         # Classify test images
-        for image in os.listdir('test-images'):
-            image_data = open(os.path.join('test-images',image), "rb").read()
-            results = prediction_client.classify_image(project_id, model_name, image_data)
+        for image in sorted(os.listdir('test-images')):
+            with open(os.path.join('test-images',image), "rb") as image_file:
+                image_data = image_file.read()
+            results = limiter.call(prediction_client.classify_image, project_id, model_name, image_data)
 
             # Loop over each label prediction and print any with probability > 50%
             for prediction in results.predictions:
-                if prediction.probability > 0.5:
+                if prediction.probability > args.threshold:
                     print(image, ': {} ({:.0%})'.format(prediction.tag_name, prediction.probability))
     except Exception as ex:
         print(ex)
 
+
+class PredictionCache:
+    # Predictions per (project, model name, iteration, image hash), appended to a
+    # JSON Lines file as they arrive. Republishing the model name to a new iteration
+    # makes every cached prediction for it stale.
+
+    def __init__(self, path, project_id, model_name):
+        self.path = path
+        self.project_id = str(project_id)
+        self.model_name = model_name
+        self.predictions = {}  # (iteration, hash) -> [(tag, probability)]
+        self.hashes = set()    # Images cached for any iteration
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record['project'] == self.project_id and record['model'] == model_name:
+                        self.predictions[(record['iteration'], record['hash'])] = record['predictions']
+                        self.hashes.add(record['hash'])
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def get(self, iteration, image_hash):
+        return self.predictions.get((iteration, image_hash))
+
+    def known(self, image_hash):
+        return image_hash in self.hashes
+
+    def put(self, iteration, image_hash, predictions):
+        with self._lock:
+            self.predictions[(iteration, image_hash)] = predictions
+            self.hashes.add(image_hash)
+            self._file.write(json.dumps({'project': self.project_id, 'model': self.model_name,
+                                         'iteration': iteration, 'hash': image_hash,
+                                         'predictions': predictions}) + '\n')
+            self._file.flush()
+
+
+def Labeled_Images(folder):
+    # (path, true tag) for each image in the tag subfolders
+    images = []
+    for tag in sorted(os.listdir(folder)):
+        tag_folder = os.path.join(folder, tag)
+        if os.path.isdir(tag_folder):
+            for name in sorted(os.listdir(tag_folder)):
+                if name.lower().endswith(IMAGE_EXTENSIONS):
+                    images.append((os.path.join(tag_folder, name), tag))
+    return images
+
+
+def Image_Hash(path):
+    with open(path, 'rb') as image_file:
+        return hashlib.sha256(image_file.read()).hexdigest()
+
+
+def Classify(prediction_client, project_id, model_name, path):
+    # Returns (iteration ID, [(tag, probability)], latency in ms). The latency is
+    # measured around the request only, not the wait for a slot in the limiter.
+    with open(path, 'rb') as image_file:
+        image_data = image_file.read()
+
+    def Request():
+        start = time.perf_counter()
+        results = prediction_client.classify_image(project_id, model_name, image_data)
+        return results, (time.perf_counter() - start) * 1000
+
+    results, latency_ms = limiter.call(Request)
+    return results.iteration, [(p.tag_name, p.probability) for p in results.predictions], latency_ms
+
+
+def Evaluate_Model(prediction_client, project_id, model_name, folder, cache_file=CACHE_FILE, output='evaluation.csv',
+                   workers=8, threshold=0.5):
+    images = Labeled_Images(folder)
+    if not images:
+        print('No labeled images found in', folder)
+        return
+    hashes = [Image_Hash(path) for path, tag in images]
+    start = time.perf_counter()
+
+    # One (predictions, latency in ms or None if cached, error or None) per image
+    rows = [None] * len(images)
+
+    with PredictionCache(cache_file, project_id, model_name) as cache:
+        # The iteration behind the model name is only known from a prediction. Probe with
+        # an image that is not cached yet (it has to be classified anyway) or, if all are
+        # cached, with the first one. An image that fails is recorded and the next one tried.
+        candidates = [i for i, h in enumerate(hashes) if not cache.known(h)] or [0]
+        iteration = None
+        for probe in candidates[:PROBE_ATTEMPTS]:
+            try:
+                iteration, predictions, latency_ms = Classify(prediction_client, project_id, model_name,
+                                                              images[probe][0])
+            except Exception as ex:
+                rows[probe] = ([], None, str(ex))
+                continue
+            cache.put(iteration, hashes[probe], predictions)
+            rows[probe] = (predictions, latency_ms, None)
+            break
+        if iteration is None:
+            raise RuntimeError('{} images failed in a row; last error: {}'.format(PROBE_ATTEMPTS, rows[probe][2]))
+        print('Evaluating {} images against {} (iteration {})'.format(len(images), model_name, iteration))
+
+        todo = []
+        for i in range(len(images)):
+            if rows[i] is None:
+                cached = cache.get(iteration, hashes[i])
+                if cached is None:
+                    todo.append(i)
+                else:
+                    rows[i] = (cached, None, None)  # Cached: no latency
+
+        # New images are classified in parallel with a bounded number of calls in flight
+        todo = iter(todo)
+        pending = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                for i in todo:
+                    pending[pool.submit(Classify, prediction_client, project_id, model_name, images[i][0])] = i
+                    if len(pending) >= workers * 2:
+                        break
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i = pending.pop(future)
+                    try:
+                        result_iteration, predictions, latency_ms = future.result()
+                    except Exception as ex:
+                        rows[i] = ([], None, str(ex))
+                        continue
+                    if result_iteration != iteration:
+                        raise RuntimeError('{} was republished during the evaluation'.format(model_name))
+                    cache.put(iteration, hashes[i], predictions)
+                    rows[i] = (predictions, latency_ms, None)
+
+    elapsed = time.perf_counter() - start
+    calls = sum(1 for predictions, latency_ms, error in rows if latency_ms is not None)
+    failed = [i for i, (predictions, latency_ms, error) in enumerate(rows) if error is not None]
+    print('{} images, {} predictions requested ({} cached, {} failed) in {:.1f}s\n'.format(
+        len(images), calls, len(images) - calls - len(failed), len(failed), elapsed))
+    for i in failed[:10]:
+        print(' {}: {}'.format(images[i][0], rows[i][2]))
+    if len(failed) > 10:
+        print(' ...')
+    if failed:
+        print()
+
+    # The report covers the images that were classified; failures are only in the CSV
+    predicted = [None if error else Top_Tag(predictions, threshold) for predictions, latency_ms, error in rows]
+    evaluated = [i for i in range(len(images)) if rows[i][2] is None]
+    Print_Report([images[i][1] for i in evaluated], [predicted[i] for i in evaluated])
+    Print_Latency([latency_ms for predictions, latency_ms, error in rows if latency_ms is not None])
+
+    with open(output, 'w', newline='', encoding='utf-8') as out:
+        writer = csv.writer(out)
+        writer.writerow(['image', 'tag', 'predicted', 'probability', 'latency_ms', 'error'])
+        for (path, tag), (predictions, latency_ms, error), guess in zip(images, rows, predicted):
+            probability = max((p for t, p in predictions), default=0.0)
+            writer.writerow([path, tag, guess or '', '' if error else round(probability, 4),
+                             '' if latency_ms is None else round(latency_ms, 1), error or ''])
+    print('\nResults saved in', output)
+
+
+def Top_Tag(predictions, threshold):
+    tag, probability = max(predictions, key=lambda p: p[1], default=(NO_TAG, 0.0))
+    return tag if probability > threshold else NO_TAG
+
+
+def Print_Report(truth, predicted):
+    # Confusion matrix (rows: true tag, columns: predicted tag) and per-tag precision/recall
+    tags = sorted(set(truth) | set(predicted) - {NO_TAG})
+    columns = tags + ([NO_TAG] if NO_TAG in predicted else [])
+    index = {tag: i for i, tag in enumerate(columns)}
+    matrix = np.zeros((len(tags), len(columns)), dtype=np.int64)
+    np.add.at(matrix, ([index[t] for t in truth], [index[p] for p in predicted]), 1)
+
+    width = max(8, max(len(tag) for tag in columns) + 1)
+    print('Confusion matrix (rows: actual, columns: predicted)')
+    print(' ' * width + ''.join('{:>{w}}'.format(tag, w=width) for tag in columns))
+    for tag, row in zip(tags, matrix):
+        print('{:<{w}}'.format(tag, w=width) + ''.join('{:>{w}}'.format(n, w=width) for n in row))
+
+    correct = np.diag(matrix[:, :len(tags)])
+    predicted_count = matrix[:, :len(tags)].sum(axis=0)
+    actual_count = matrix.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(predicted_count > 0, correct / predicted_count, 0.0)
+        recall = np.where(actual_count > 0, correct / actual_count, 0.0)
+        f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+
+    print('\n{:<{w}} {:>9} {:>7} {:>7} {:>8}'.format('Tag', 'Precision', 'Recall', 'F1', 'Images', w=width))
+    for tag, p, r, f, n in zip(tags, precision, recall, f1, actual_count):
+        print('{:<{w}} {:>9.1%} {:>7.1%} {:>7.2f} {:>8}'.format(tag, p, r, f, n, w=width))
+    print('Accuracy: {:.1%}'.format(correct.sum() / max(1, len(truth))))
+
+
+def Print_Latency(latencies):
+    if not latencies:
+        print('\nNo new predictions; latency not measured')
+        return
+    latencies = np.array(latencies)
+    counts = np.bincount(np.searchsorted(LATENCY_BUCKETS, latencies), minlength=len(LATENCY_BUCKETS) + 1)
+    labels = ['<= {} ms'.format(b) for b in LATENCY_BUCKETS] + ['> {} ms'.format(LATENCY_BUCKETS[-1])]
+    scale = 40 / counts.max()
+    print('\nLatency of {} requests: p50 {:.0f} ms, p90 {:.0f} ms, p99 {:.0f} ms'.format(
+        len(latencies), *np.percentile(latencies, [50, 90, 99])))
+    for label, count in zip(labels, counts):
+        print(' {:>10} {:>6} {}'.format(label, count, '#' * int(round(count * scale))))
+
 if __name__ == "__main__":
     main()
-
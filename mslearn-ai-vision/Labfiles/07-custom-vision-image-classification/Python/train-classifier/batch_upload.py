@@ -0,0 +1,82 @@
+# Batched image uploads to a Custom Vision project, kept in step with the upload manifest.
+#
+# Images are grouped into batches of up to 64 and each file is read only when its
+# batch is built. Every result is matched to its image by the name the service
+# echoes back, since nothing guarantees the results come back in the order the
+# images were sent; an image without a result counts as failed. Images that
+# failed for transient reasons are sent again, and every confirmed image is
+# recorded in the manifest right away.
+#
+# The training labs are run on their own from their own directory, so each one
+# keeps an identical copy of this file (like upload_manifest.py). Change them together.
+import random
+import time
+
+from azure.cognitiveservices.vision.customvision.training.models import ImageFileCreateBatch, ImageFileCreateEntry
+
+from upload_manifest import ContentHash
+
+# The service accepts at most 64 images per create_images_from_files call
+MAX_BATCH_SIZE = 64
+# Per-image statuses worth another attempt (the rest are problems with the image itself)
+RETRY_IMAGE_STATUSES = ('ErrorStorage', 'ErrorUnknown')
+MAX_IMAGE_RETRIES = 3
+# Status reported for an image the service sent no result for
+NO_RESULT_STATUS = 'ErrorNoResult'
+
+
+def Image_Batches(images, manifest, counts, batch_size=MAX_BATCH_SIZE):
+    # images yields (name, path, signature, fields): the signature is what the manifest
+    # compares besides the content (tags or regions), and fields holds the tag_ids or
+    # regions for the entry. Yields batches of (entry, hash, signature, old image ID)
+    # for the images that need uploading.
+    batch = []
+    for name, path, signature, fields in images:
+        with open(path, 'rb') as image_file:
+            contents = image_file.read()
+        content_hash = ContentHash(contents)
+        status = manifest.status(name, content_hash, signature)
+        if status == 'current':
+            counts['unchanged'] += 1
+            continue
+        old_id = manifest.image_id(name) if status == 'changed' else None
+        batch.append((ImageFileCreateEntry(name=name, contents=contents, **fields), content_hash, signature, old_id))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def Upload_Batch(client, project_id, limiter, batch, manifest):
+    # Uploads one batch and retries the images that failed for transient reasons.
+    # Images whose content, tags or regions changed replace the old copy in the project.
+    # Returns (name, status) for every image in the batch.
+    old_ids = [old_id for entry, content_hash, signature, old_id in batch if old_id]
+    if old_ids:
+        limiter.call(client.delete_images, project_id, image_ids=old_ids)
+        for entry, content_hash, signature, old_id in batch:
+            if old_id:
+                manifest.forget(entry.name)
+
+    items = {entry.name: (entry, content_hash, signature) for entry, content_hash, signature, old_id in batch}
+    names = list(items)
+    statuses = {}
+    for attempt in range(MAX_IMAGE_RETRIES + 1):
+        upload_result = limiter.call(client.create_images_from_files, project_id,
+                                     ImageFileCreateBatch(images=[items[name][0] for name in names]))
+        # For file uploads the service reports the entry name as the source URL
+        results = {image.source_url: image for image in upload_result.images or []}
+        for name in names:
+            image = results.get(name)
+            statuses[name] = image.status if image is not None else NO_RESULT_STATUS
+            if image is not None and image.status.startswith('OK') and image.image is not None:
+                entry, content_hash, signature = items[name]
+                manifest.record(name, content_hash, image.image.id, signature)
+
+        names = [name for name in names if statuses[name] in RETRY_IMAGE_STATUSES]
+        if not names or attempt == MAX_IMAGE_RETRIES:
+            break
+        time.sleep(random.uniform(0, limiter.base_delay * 2 ** attempt))
+    return [(name, statuses[name]) for name in items]
+
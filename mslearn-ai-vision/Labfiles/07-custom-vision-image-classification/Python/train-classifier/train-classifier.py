@@ -1,55 +1,330 @@
 from azure.cognitiveservices.vision.customvision.training import CustomVisionTrainingClient
-from azure.cognitiveservices.vision.customvision.training.models import ImageFileCreateBatch, ImageFileCreateEntry, Region
 from msrest.authentication import ApiKeyCredentials
+import argparse
+import json
+import threading
 import time
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Shared limiter with retries on 429 for every training API call
+from rate_limiter import RateLimiter
+# Local record of what is already in the project, so re-runs only upload changes
+from upload_manifest import UploadManifest
+# Batching, result matching and per-image retries shared with the object detection lab
+from batch_upload import Image_Batches, Upload_Batch
+
+limiter = RateLimiter(rate=10)
+
+MANIFEST_FILE = 'upload-manifest.jsonl'
+
+# Polling of long-running training and export operations: the delay starts short
+# and doubles up to the maximum, so a 10 minute training takes a handful of calls
+POLL_INITIAL_DELAY = 5
+POLL_MAX_DELAY = 60
+TRAINING_TIMEOUT = 2 * 60 * 60
+
+
+class TrainingFailed(Exception):
+    pass
+
+
+# Background waiters for trainings started with Train_Model(wait=False) in a
+# long-running process. They sleep between polls, so a few threads can follow the
+# trainings of many projects; the process does not exit while they are waiting.
+training_waiters = ThreadPoolExecutor(max_workers=8, thread_name_prefix='training-waiter')
 
 def main():
     from dotenv import load_dotenv
     global training_client
     global custom_vision_project
 
+    parser = argparse.ArgumentParser(description='Upload images and train a Custom Vision classifier')
+    parser.add_argument('folder', nargs='?', default='more-training-images', help='Folder with one subfolder per tag')
+    parser.add_argument('--workers', type=int, default=4, help='Batches uploaded in parallel')
+    parser.add_argument('--manifest', default=MANIFEST_FILE, help='Record of the images already uploaded')
+    parser.add_argument('--benchmark', action='store_true', help='Compare per-image and batched uploads against a local stub')
+    parser.add_argument('--publish-name', help='Publish the trained iteration under this name (default: PublishName)')
+    parser.add_argument('--prediction-resource',
+                        help='Resource ID of the prediction resource to publish to (default: PredictionResourceId)')
+    parser.add_argument('--export', help='Export the trained iteration to this platform (ONNX, TensorFlow, CoreML, ...)')
+    parser.add_argument('--timeout', type=float, default=TRAINING_TIMEOUT, help='Seconds to wait for training')
+    parser.add_argument('--no-wait', action='store_true',
+                        help='Exit as soon as training starts; publish and export later with --wait-iteration')
+    parser.add_argument('--wait-iteration', metavar='ITERATION_ID',
+                        help='Wait for a training started with --no-wait, then publish and export it (no upload)')
+    args = parser.parse_args()
+
     try:
+        if args.benchmark:
+            Benchmark_Upload(args.folder)
+            return
+
         # Get Configuration Settings
         load_dotenv()
         training_endpoint = os.getenv('TrainingEndpoint')
         training_key = os.getenv('TrainingKey')
         project_id = os.getenv('ProjectID')
+        publish_name = args.publish_name or os.getenv('PublishName')
+        prediction_resource_id = args.prediction_resource or os.getenv('PredictionResourceId')
 
         # Authenticate a client for the training API
         credentials = ApiKeyCredentials(in_headers={"Training-key": training_key})
         training_client = CustomVisionTrainingClient(training_endpoint, credentials)
+        training_client.config.retry_policy.retries = 0  # Retries are handled by the limiter
+        training_client.config.keep_alive = True
 
         # Get the Custom Vision project
         custom_vision_project = training_client.get_project(project_id)
 
+        if args.wait_iteration:
+            # Resume a training started with --no-wait
+            Finish_Training(custom_vision_project.id, args.wait_iteration, publish_name, prediction_resource_id,
+                            args.export, args.timeout)
+            return
+
         # Upload and tag images
-        Upload_Images('more-training-images')
+        Upload_Images(args.folder, workers=args.workers, manifest_file=args.manifest)
 
         # Train the model
-        Train_Model()
+        if args.no_wait:
+            iteration_id = Start_Training()
+            print("Training started (iteration {}). Finish it with --wait-iteration {}".format(iteration_id, iteration_id))
+        else:
+            Train_Model(publish_name=publish_name, prediction_resource_id=prediction_resource_id,
+                        export_platform=args.export, timeout=args.timeout)
         
     except Exception as ex:
         print(ex)
 
-def Upload_Images(folder):
+def Upload_Images(folder, workers=4, manifest_file=MANIFEST_FILE):
     print("Uploading images...")
     tags = training_client.get_tags(custom_vision_project.id)
+    with UploadManifest(manifest_file, custom_vision_project.id) as manifest:
+        Upload_Files(Tagged_Files(folder, tags), manifest, workers)
+
+
+def Tagged_Files(folder, tags):
+    # Yields (name, path, tag IDs, fields) for the images in each tag's subfolder
     for tag in tags:
-        print(tag.name)
-        for image in os.listdir(os.path.join(folder,tag.name)):
-            image_data = open(os.path.join(folder,tag.name,image), "rb").read()
-            training_client.create_images_from_data(custom_vision_project.id, image_data, [tag.id])
+        tag_folder = os.path.join(folder, tag.name)
+        if not os.path.isdir(tag_folder):
+            continue
+        for image in sorted(os.listdir(tag_folder)):
+            yield os.path.join(tag.name, image), os.path.join(tag_folder, image), [tag.id], {'tag_ids': [tag.id]}
+
 
-def Train_Model():
+def Upload_Files(tagged_files, manifest, workers=4):
+    # Images from all tags are grouped into batches of up to 64 and several batches
+    # are uploaded at a time; only the batches in flight are held in memory
+    counts = {'unchanged': 0}
+    batches = Image_Batches(tagged_files, manifest, counts)
+    pending = set()
+    uploaded = duplicates = 0
+    failed = []
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            for batch in batches:
+                pending.add(pool.submit(Upload_Batch, training_client, custom_vision_project.id, limiter, batch, manifest))
+                if len(pending) >= workers:
+                    break
+            if not pending:
+                break
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results = future.result()
+                uploaded += sum(1 for name, status in results if status == 'OK')
+                duplicates += sum(1 for name, status in results if status == 'OKDuplicate')
+                failed += [(name, status) for name, status in results if not status.startswith('OK')]
+
+    elapsed = time.perf_counter() - start
+    print("{} images uploaded, {} duplicates, {} failed, {} unchanged in {:.1f}s".format(
+        uploaded, duplicates, len(failed), counts['unchanged'], elapsed))
+    for name, status in failed:
+        print("Image status: ", name, status)
+    return uploaded + duplicates, elapsed
+
+
+def Train_Model(wait=True, publish_name=None, prediction_resource_id=None, export_platform=None,
+                timeout=TRAINING_TIMEOUT):
+    # Starts training and hands the rest (waiting, publishing, exporting) to a background
+    # waiter. Returns a Future with the trained iteration; with wait=False it returns
+    # right away and callers can attach add_done_callback to react when it finishes.
+    # The waiter keeps the process alive until then; to exit right away, use
+    # Start_Training and later Finish_Training with the iteration ID.
+    iteration_id = Start_Training()
+    job = training_waiters.submit(Finish_Training, custom_vision_project.id, iteration_id,
+                                  publish_name, prediction_resource_id, export_platform, timeout)
+    if wait:
+        job.result()
+    else:
+        print("Training started (iteration {}); waiting in the background".format(iteration_id))
+        job.add_done_callback(Report_Training)
+    return job
+
+
+def Start_Training():
+    # Returns the ID of the new iteration without waiting for it
     print("Training ...")
-    iteration = training_client.train_project(custom_vision_project.id)
-    while (iteration.status != "Completed"):
-        iteration = training_client.get_iteration(custom_vision_project.id, iteration.id)
-        print (iteration.status, '...')
-        time.sleep(5)
+    iteration = limiter.call(training_client.train_project, custom_vision_project.id)
+    return iteration.id
+
+
+def Finish_Training(project_id, iteration_id, publish_name, prediction_resource_id, export_platform, timeout):
+    iteration = Wait_For_Iteration(project_id, iteration_id, timeout)
     print ("Model trained!")
 
+    if publish_name and prediction_resource_id:
+        limiter.call(training_client.publish_iteration, project_id, iteration.id, publish_name, prediction_resource_id)
+        print("Published as", publish_name)
+
+    if export_platform:
+        download_uri = Export_Iteration(project_id, iteration.id, export_platform, timeout)
+        print("Exported to {}: {}".format(export_platform, download_uri))
+    return iteration
+
+
+def Report_Training(job):
+    # Errors of background trainings would otherwise go unnoticed
+    if job.exception() is not None:
+        print(job.exception())
+
+
+def Poll(fetch, timeout, describe):
+    # Calls fetch() with exponential backoff until it returns a (status, value) whose
+    # status is final; prints each status once instead of on every poll
+    deadline = time.monotonic() + timeout
+    delay = POLL_INITIAL_DELAY
+    last_status = None
+    while True:
+        status, value = fetch()
+        if status != last_status:
+            print (describe, status, '...')
+            last_status = status
+        if status in ('Completed', 'Done'):
+            return value
+        if status == 'Failed':
+            raise TrainingFailed('{} failed'.format(describe))
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError('{} still {} after {:g}s'.format(describe, status, timeout))
+        time.sleep(min(delay, remaining))
+        delay = min(POLL_MAX_DELAY, delay * 2)
+
+
+def Wait_For_Iteration(project_id, iteration_id, timeout=TRAINING_TIMEOUT):
+    def Fetch():
+        iteration = limiter.call(training_client.get_iteration, project_id, iteration_id)
+        return iteration.status, iteration
+
+    return Poll(Fetch, timeout, 'Iteration {}'.format(iteration_id))
+
+
+def Export_Iteration(project_id, iteration_id, platform, timeout=TRAINING_TIMEOUT):
+    # Starts the export and waits for its download link
+    limiter.call(training_client.export_iteration, project_id, iteration_id, platform)
+
+    def Fetch():
+        exports = limiter.call(training_client.get_exports, project_id, iteration_id)
+        export = next((e for e in exports if e.platform == platform), None)
+        if export is None:
+            return 'Exporting', None
+        return export.status, export.download_uri
+
+    return Poll(Fetch, timeout, '{} export'.format(platform))
+
+
+#! Benchmark: per-image uploads vs batched uploads against a local stub of the training API
+def Start_Stub_Server(latency=0.05):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(latency)  # Simulated service latency per request
+            # /images/files takes a JSON batch and each result names its image, as the service
+            # does (names picked out without parsing the contents); /images takes one multipart image
+            if self.path.split('?')[0].endswith('/files'):
+                names = [name.decode('utf-8') for name in re.findall(rb'"name": ?"([^"]*)"', body)]
+            else:
+                names = ['']
+            images = [{'sourceUrl': name, 'status': 'OK', 'image': {'id': '00000000-0000-0000-0000-{:012d}'.format(i)}}
+                      for i, name in enumerate(names)]
+            self.send_json({'isBatchSuccessful': True, 'images': images})
+
+        def do_GET(self):
+            self.send_json({'id': 'stub', 'name': 'stub', 'settings': {}})
+
+        def send_json(self, value):
+            body = json.dumps(value).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class StubServer(ThreadingHTTPServer):
+        request_queue_size = 128  # Parallel connections do not wait in the socket queue
+
+    server = StubServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def Benchmark_Upload(folder, images=512, latency=0.05, workers=4):
+    global training_client
+    global custom_vision_project
+    global limiter
+
+    # The sample images are repeated under different names to reach the requested count
+    files = [(os.path.join(tag, name), os.path.join(folder, tag, name), [tag], {'tag_ids': [tag]})
+             for tag in sorted(os.listdir(folder)) if os.path.isdir(os.path.join(folder, tag))
+             for name in sorted(os.listdir(os.path.join(folder, tag)))]
+    if not files:
+        print('No images found in', folder)
+        return
+    files = [('{}-{}'.format(i, name), path, tag_ids, fields) for i, (name, path, tag_ids, fields) in
+             enumerate((files * (images // len(files) + 1))[:images])]
+
+    server = Start_Stub_Server(latency)
+    training_client = CustomVisionTrainingClient('http://127.0.0.1:{}'.format(server.server_address[1]),
+                                                 ApiKeyCredentials(in_headers={'Training-key': 'stub'}))
+    training_client.config.retry_policy.retries = 0
+    training_client.config.keep_alive = True
+    custom_vision_project = training_client.get_project('stub')
+    limiter = RateLimiter(rate=1000)  # No quota on the stub: only the request pattern is measured
+
+    print('Benchmarking {} images against stub server ({:.0f} ms latency per request)'.format(len(files), latency * 1000))
+    try:
+        # Before: one create_images_from_data call per image, in sequence
+        start = time.perf_counter()
+        for name, path, tag_ids, fields in files:
+            with open(path, 'rb') as image_file:
+                training_client.create_images_from_data(custom_vision_project.id, image_file.read(), tag_ids)
+        sequential = len(files) / (time.perf_counter() - start)
+
+        # After: batches of 64 across tags, uploaded in parallel
+        with UploadManifest(os.devnull, custom_vision_project.id) as manifest:
+            uploaded, elapsed = Upload_Files(iter(files), manifest, workers)
+        batched = uploaded / elapsed
+    finally:
+        server.shutdown()
+
+    print('\n Mode                    Images/sec')
+    print(' {:<22} {:>11.1f}'.format('Per image (before)', sequential))
+    print(' {:<22} {:>11.1f}'.format('Batched x{} (after)'.format(workers), batched))
+    print(' Speedup: {:.1f}x'.format(batched / sequential))
+
 
 if __name__ == "__main__":
     main()